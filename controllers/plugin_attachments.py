@@ -5,7 +5,9 @@ def index():
     a.record_id.default=record_id=request.args(1)
     #if request.args(2): a.file.writable=False
     form=crud.update(a,request.args(2),
-                     next=URL(r=request,args=request.args[:2]))
+                     next=URL(r=request,args=request.args[:2]),
+                     onaccept=plugin_attachments_onaccept,
+                     ondelete=plugin_attachments_ondelete)
     rows=db(a.tablename==tablename)(a.record_id==record_id)\
         .select(orderby=a.name)
     return dict(form=form,rows=rows)
@@ -13,7 +15,25 @@ def index():
 def attachment():
     a=db.plugin_attachments_attachment
     try:
-        request.args[0]=a[request.args(0).split('.')[0]].file
+        name=a[request.args(0).split('.')[0]].file
     except:
         raise HTTP(400)
-    return response.download(request,db)
+    from gluon.contenttype import contenttype
+    plugin_attachments_serve(plugin_attachments_path(name),'"%s"' % name,contenttype(name),
+                             plugin_attachments_filename(name))
+
+def preview():
+    import os
+    a=db.plugin_attachments_attachment
+    try:
+        name=a[request.args(0).split('.')[0]].file
+    except:
+        raise HTTP(400)
+    kind=request.args(1) or 'thumb'
+    if not kind in ('thumb','text'):
+        raise HTTP(400)
+    path=plugin_attachments_lib.derived(plugin_attachments_path(name),kind)
+    if not os.path.exists(path):
+        plugin_attachments_derive(name)
+    plugin_attachments_serve(path,'"%s.%s"' % (name,kind),
+                             kind=='thumb' and 'image/png' or 'text/plain; charset=utf-8')
@@ -9,13 +9,29 @@ def SUL(*a,**b): return UL(*[u for u in a if u],**b)
 script=SCRIPT("""
 var action = null;
 var formhtml = null;
+function plugin_comments_expand(div,toggle) {
+  var ul = div.next().next();
+  if(ul.hasClass('unloaded')) {
+    ul.removeClass('unloaded');
+    jQuery.get(action+'/subtree/'+div.attr('id'),null,
+               function(data,r){ ul.html(data);
+                                 ul.find('ul').hide();
+                                 plugin_comments_init();
+                                 ul.slideDown(); },'html');
+  } else if(toggle) ul.slideToggle();
+  else ul.slideDown();
+}
 function plugin_comments_init() {
+  if(plugin_comments_user) {
+    jQuery('div.plugin_comments span.user').show();
+    jQuery('div.plugin_comments span.u'+plugin_comments_user).show();
+  }
   function delete_all_forms() { jQuery('div.plugin_comments .reply').html(''); }
   function capture_form() {
-     jQuery('div.plugin_comments #close').click(function(){
+     jQuery('div.plugin_comments #close').unbind('click').click(function(){
        delete_all_forms();
      });
-    jQuery('div.plugin_comments :submit').click(function(){
+    jQuery('div.plugin_comments :submit').unbind('click').click(function(){
       var form = jQuery(this).parent()
       var body = form.children('textarea[name="body"]').val();
        jQuery.post(action+'/'+form.parent().prev().attr('id'),
@@ -28,19 +44,28 @@ function plugin_comments_init() {
       return false;
     });
   }
-  jQuery('div.plugin_comments #toggle').click(function(){
-     jQuery(this).parent().next().next().slideToggle();
+  jQuery('div.plugin_comments #toggle').unbind('click').click(function(){
+     plugin_comments_expand(jQuery(this).parent(),true);
   });
-  jQuery('div.plugin_comments #reply').click(function(){
+  jQuery('div.plugin_comments #reply').unbind('click').click(function(){
      delete_all_forms();
-     jQuery(this).parent().next().next().slideDown();
-     jQuery(this).parent().next().html(formhtml); capture_form();
+     plugin_comments_expand(jQuery(this).closest('div'),false);
+     jQuery(this).closest('div').next().html(formhtml); capture_form();
   });
-  jQuery('div.plugin_comments #delete').click(function(){
+  jQuery('div.plugin_comments #delete').unbind('click').click(function(){
     delete_all_forms();
-    var parent = jQuery(this).parent()
+    var parent = jQuery(this).closest('div')
     jQuery.post(action+'/delete/'+parent.attr('id'),null,function(data,r){parent.html('deleted');});
   });
+  jQuery('div.plugin_comments li.more a').unbind('click').click(function(){
+    var li = jQuery(this).parent();
+    jQuery.get(action+'/page/'+li.attr('id').substr(1),null,
+               function(data,r){ var items = jQuery(data);
+                                 items.find('ul').hide();
+                                 li.replaceWith(items);
+                                 plugin_comments_init(); },'html');
+    return false;
+  });
 }
 jQuery(document).ready(function() {
   action = jQuery('div.plugin_comments form').attr('action');
@@ -51,42 +76,147 @@ jQuery(document).ready(function() {
 );
 """)
 
+def tree(comments):
+    """
+    groups comments by parent_node preserving their order, in O(n)
+    """
+    thread = {}
+    for comment in comments:
+        thread.setdefault(comment.parent_node or 0,[]).append(comment)
+    return thread
+
+def node(comment,thread):
+    """
+    thread maps a comment id to the list of its replies, or to None
+    if it has replies that are loaded on demand via subtree.
+    The output does not depend on the current user (reply and delete
+    links are revealed client side) so it can be cached and shared.
+    """
+    if not comment.id in thread:
+        replies = UL()
+    elif thread[comment.id] is None:
+        replies = UL(_class='unloaded')
+    else:
+        replies = SUL(*[node(reply,thread) for reply in thread[comment.id]])
+    if not comment.deleted:
+        return LI(
+            DIV(I('"'+comment.body+'"'),BR(),
+                T('posted by %(first_name)s %(last_name)s',comment.created_by),
+                ' ',T('on %s',comment.created_on),' [',
+                A(T('toggle'),_id='toggle'),
+                SPAN('|',A(T('reply'),_id='reply'),
+                     _class='user',_style='display:none'),
+                SPAN('|',A(T('delete'),_id='delete'),
+                     _class='u%s' % comment.created_by,_style='display:none'),
+                ']',_id='r%s' % comment.id),
+            DIV(_class='reply'),
+            replies)
+    elif comment.id in thread:
+        return LI(
+            DIV(T('DELETED'),' [',
+                A(T('toggle'),_id='toggle'),']',_id='r%s' % comment.id),
+            DIV(_class='reply'),
+            replies)
+    else:
+        return None
+
+def path(tablename,record_id,comment_id):
+    """
+    returns the materialized path of a comment ('12/45/' for a reply 45
+    to comment 12). Comments posted before paths existed get the paths
+    of their whole thread filled in once.
+    """
+    thread = db(dbco.tablename==tablename)(dbco.record_id==record_id)
+    comment = thread(dbco.id==comment_id).select(dbco.id,dbco.path).first() or error()
+    if not comment.path:
+        children = tree(thread.select(dbco.id,dbco.parent_node,dbco.path,orderby=dbco.id))
+        paths, stack = {}, [(0,'')]
+        while stack:
+            parent, prefix = stack.pop()
+            for child in children.get(parent,[]):
+                paths[child.id] = '%s%s/' % (prefix,child.id)
+                if child.path != paths[child.id]:
+                    thread(dbco.id==child.id).update(path=paths[child.id])
+                stack.append((child.id,paths[child.id]))
+        comment.path = paths.get(comment.id) or error()
+    return comment.path
+
+def cached(tablename,record_id,key,f):
+    """
+    caches the html rendered by f for a thread, see invalidate
+    """
+    key = 'plugin_comments_%s_%s_%s_%s' % (tablename,record_id,key,T.accepted_language)
+    return plugin_comments_cache(key,lambda: TAG[''](*[item for item in f() if item]).xml(),3600)
+
+def invalidate(tablename,record_id):
+    """
+    drops the cached fragments of one thread only
+    """
+    plugin_comments_cache.clear(regex='^plugin_comments_%s_%s_' % (re.escape(tablename),
+                                                                  re.escape(str(record_id))))
+
+def roots(tablename,record_id,page):
+    """
+    one page of top level comments; their replies are loaded on demand
+    """
+    n = plugin_comments_items_per_page
+    thread = db(dbco.tablename==tablename)(dbco.record_id==record_id)
+    comments = [comment for comment in thread(dbco.parent_node==0)\
+                    .select(orderby=~dbco.created_on,limitby=(page*n,(page+1)*n+1))]
+    items = {0:comments[:n]}
+    ids = [comment.id for comment in items[0]]
+    if ids:
+        for row in thread(dbco.parent_node.belongs(ids))\
+                .select(dbco.parent_node,distinct=True):
+            items[row.parent_node] = None
+    nodes = [node(comment,items) for comment in items[0]]
+    if len(comments)>n:
+        nodes.append(LI(A(T('more'),_href='#'),_id='p%s' % (page+1),_class='more'))
+    return nodes
+
+def subtree(tablename,record_id,comment_id):
+    """
+    all the replies below a comment, fetched with one range query on path
+    """
+    prefix = path(tablename,record_id,comment_id)
+    comments = db(dbco.tablename==tablename)(dbco.record_id==record_id)\
+        (dbco.path.like(prefix+'%'))(dbco.id!=comment_id)\
+        .select(orderby=~dbco.created_on)
+    thread = tree(comments)
+    return [node(comment,thread) for comment in thread.get(int(comment_id),[])]
+
 def index():
     tablename = request.args(0) or error()
     record_id = request.args(1) or error()
-    parent_id = request.args(2) # must be None, 'delete', 'r0', 'r#'
-    thread = {0:[]}
-    def node(comment):
-        if not comment.deleted:
-            return LI(
-                DIV(I('"'+comment.body+'"'),BR(),
-                    T('posted by %(first_name)s %(last_name)s',comment.created_by),
-                    ' ',T('on %s',comment.created_on),' [',
-                    A(T('toggle'),_id='toggle'),
-                    '|' if auth.user_id else '',
-                    A(T('reply'),_id='reply') if auth.user_id else '',
-                    '|' if comment.created_by == auth.user_id else '',
-                    A(T('delete'),_id='delete') if comment.created_by == auth.user_id else '',
-                    ']',_id='r%s' % comment.id),
-                DIV(_class='reply'),
-                SUL(*[node(comment) for comment in thread.get(comment.id,[])]))
-        elif comment.id in thread:
-            return LI(
-                DIV(T('DELETED'),' [',
-                    A(T('toggle'),_id='toggle'),']'),
-                DIV(_class='reply'),
-                SUL(*[node(comment) for comment in thread.get(comment.id,[])]))
-        else:
-            return None
+    parent_id = request.args(2) # must be None, 'delete', 'subtree', 'page', 'r0', 'r#'
     if parent_id == 'delete':
         if db(dbco.created_by==auth.user_id)(dbco.tablename==tablename)\
-                (dbco.record_id==record_id)(dbco.id==request.args(3)[1:]).update(deleted=True):
+                (dbco.record_id==record_id)(dbco.id==request.args(3)[1:])\
+                (dbco.deleted==False).update(deleted=True):
+            plugin_comments_count(tablename,record_id,-1)
+            invalidate(tablename,record_id)
             return 'deleted'
         else:
             return error()
+    elif parent_id == 'subtree':
+        comment_id = (request.args(3) or 'r')[1:]
+        if not comment_id.isdigit():
+            return error()
+        return cached(tablename,record_id,'s'+comment_id,
+                      lambda: subtree(tablename,record_id,comment_id))
+    elif parent_id == 'page':
+        if not (request.args(3) or '').isdigit():
+            return error()
+        page = int(request.args(3))
+        return cached(tablename,record_id,'p%s' % page,
+                      lambda: roots(tablename,record_id,page))
     elif parent_id:
-        if not request.vars.body or not auth.user_id:
+        if not request.vars.body or not auth.user_id or not parent_id[1:].isdigit():
             return error()
+        if parent_id == 'r0':
+            prefix = ''
+        else:
+            prefix = path(tablename,record_id,parent_id[1:])
         dbco.parent_node.default = parent_id[1:]
         dbco.tablename.default = tablename
         dbco.record_id.default = record_id
@@ -94,11 +224,12 @@ def index():
         if len(re.compile('\s+').sub('',request.vars.body))<1:
             return ''
         item = dbco.insert(body=request.vars.body.strip())
-        return node(item)
-    comments = db(dbco.tablename==tablename)(dbco.record_id==record_id).select(orderby=~dbco.created_on)
-    for comment in comments:
-        thread[comment.parent_node] = thread.get(comment.parent_node,[])+[comment]
-    return DIV(script,
+        db(dbco.id==item).update(path='%s%s/' % (prefix,item))
+        plugin_comments_count(tablename,record_id,+1)
+        invalidate(tablename,record_id)
+        return node(dbco[item],{})
+    return DIV(SCRIPT('var plugin_comments_user = %s;' % (auth.user_id or 0)),
+               script,
                DIV(A(T('post'),_id='reply'),_id='r0') if auth.user_id \
                    else A(T('login to post'),_href=URL(r=request,c='default',f='user')),
                DIV(FORM(TEXTAREA(_name='body',_style='width:100%; height: 40px'),
@@ -107,4 +238,6 @@ def index():
                           _target='_blank',_style='float:right; padding-right: 10px'),
                         A(T('close'),_id='close',_style='float:right; padding-right: 10px'),
                         _method='post',_action=URL(r=request,args=[tablename,record_id])),_class='reply'),
-               SUL(*[node(comment) for comment in thread[0]]),_class='plugin_comments')
+               UL(XML(cached(tablename,record_id,'p0',
+                             lambda: roots(tablename,record_id,0)))),
+               _class='plugin_comments')
@@ -0,0 +1,39 @@
+def data():
+    "dataTables sAjaxSource for plugin_datatable(dbset,...): sEcho, iDisplayStart, iDisplayLength, sSearch, iSortingCols, iSortCol_N, sSortDir_N"
+    source = (session.plugin_datatable or {}).get(request.args(0))
+    if not source:
+        raise HTTP(404)
+    tablename, columns, query = source
+    table = db[tablename]
+    dbset = db(table._id>0)(query)
+    try:
+        echo = int(request.vars.sEcho or 0)
+        start = max(int(request.vars.iDisplayStart or 0),0)
+        length = int(request.vars.iDisplayLength or 10)
+        sorting = int(request.vars.iSortingCols or 0)
+    except ValueError:
+        raise HTTP(400)
+    if length<0 or length>plugin_datatable_max_length:
+        length = plugin_datatable_max_length
+    total = displayed = dbset.count()
+    search = request.vars.sSearch
+    if search:
+        queries = [table[name].like('%'+search+'%') for name in columns \
+                       if table[name].type in ('string','text')]
+        if queries:
+            dbset = dbset(reduce(lambda a,b: a|b,queries))
+            displayed = dbset.count()
+    orderby = None
+    for i in range(sorting):
+        column = request.vars['iSortCol_%i' % i]
+        if not column or not column.isdigit() or int(column)>=len(columns):
+            raise HTTP(400)
+        field = table[columns[int(column)]]
+        if request.vars['sSortDir_%i' % i]=='desc':
+            field = ~field
+        orderby = orderby and orderby|field or field
+    records = dbset.select(orderby=orderby or table._id,limitby=(start,start+length),
+                           *[table[name] for name in columns])
+    serialize = plugin_datatable_serializer(table,columns)
+    return '{"sEcho":%i,"iTotalRecords":%i,"iTotalDisplayRecords":%i,"aaData":%s}' % \
+        (echo,total,displayed,serialize(records))
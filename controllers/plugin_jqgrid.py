@@ -3,54 +3,41 @@ def error():
 
 def data():
     "http://trirand.com/blog/jqgrid/server.php?q=1&_search=false&nd=1267835445772&rows=10&page=1&sidx=amount&sord=asc&searchField=&searchString=&searchOper="
-    from gluon.serializers import json
-    import cgi
     tablename = request.vars.tablename or error()
     columns = (request.vars.columns or error()).split(',')
     rows=int(request.vars.rows or 25)
-    page=int(request.vars.page or 0)
+    page=max(int(request.vars.page or 1),1)
     sidx=request.vars.sidx or 'id'
     sord=request.vars.sord or 'asc'
-    searchField=request.vars.searchField
-    searchString=request.vars.searchString
-    searchOper={'eq':lambda a,b: a==b,
-                'nq':lambda a,b: a!=b,
-                'gt':lambda a,b: a>b,
-                'ge':lambda a,b: a>=b,
-                'lt':lambda a,b: a<b,
-                'le':lambda a,b: a<=b,
-                'bw':lambda a,b: a.like(b+'%'),
-                'bn':lambda a,b: ~a.like(b+'%'),
-                'ew':lambda a,b: a.like('%'+b),
-                'en':lambda a,b: ~a.like('%'+b),
-                'cn':lambda a,b: a.like('%'+b+'%'),
-                'nc':lambda a,b: ~a.like('%'+b+'%'),
-                'in':lambda a,b: a.belongs(b.split()),
-                'ni':lambda a,b: ~a.belongs(b.split())}\
-                [request.vars.searchOper or 'eq']
     table=db[tablename]
     if request.vars.fieldname:
         dbset = table._db(table[request.vars.fieldname]==request.vars.fieldvalue)
     else:
         dbset = table._db(table.id>0)
-    if searchField: dbset=dbset(searchOper(table[searchField],searchString))
-    orderby = table[sidx]
-    if sord=='desc': orderby=~orderby
-    limitby=(rows*(page-1),rows*page)
+    if request.vars.filters:
+        from gluon.contrib import simplejson
+        try:
+            filters = simplejson.loads(request.vars.filters)
+        except ValueError:
+            error()
+    elif request.vars.searchField:
+        filters = {'groupOp':'AND','rules':[{'field':request.vars.searchField,
+                                             'op':request.vars.searchOper or 'eq',
+                                             'data':request.vars.searchString}]}
+    else:
+        filters = None
+    if filters and request.vars._search!='false':
+        query = plugin_jqgrid_filter(table,*plugin_jqgrid_plan(table,filters))
+        if query: dbset=dbset(query)
     fields = [table[f] for f in columns]
-    records = dbset.select(orderby=orderby,limitby=limitby,*fields)
-    nrecords = dbset.count()
-    items = {}
-    items['page']=page
-    items['total']=int((nrecords+(rows-1))/rows)
-    items['records']=nrecords
-    readable_fields=[f.name for f in fields if f.readable]
-    def f(value,fieldname):
-        r = table[fieldname].represent
-        if r: value=r(value)
-        try: return value.xml()
-        except: return cgi.escape(str(value))
-
-    items['rows']=[{'id':r.id,'cell':[f(r[x],x) for x in readable_fields]} \
-                       for r in records]
-    return json(items)
+    def serve():
+        records = plugin_jqgrid_page(dbset,table,fields,sidx,sord,page,rows)
+        nrecords = plugin_jqgrid_count(dbset,table)
+        serialize = plugin_jqgrid_serializer(table,[f.name for f in fields if f.readable])
+        return '{"page":%i,"total":%i,"records":%i,"rows":[%s]}' % \
+            (page,(nrecords+rows-1)/rows,nrecords,','.join([serialize(r) for r in records]))
+    if not tablename in plugin_jqgrid_cached:
+        return serve()
+    key = 'plugin_jqgrid_data_%s_%s_%s' % (tablename,plugin_jqgrid_version(tablename),
+                                           plugin_jqgrid_signature(dbset.query,columns,sidx,sord,page,rows))
+    return plugin_jqgrid_cache(key,serve,plugin_jqgrid_cached[tablename])
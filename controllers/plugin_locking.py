@@ -1,6 +1,12 @@
 def relock():
-    lock = db.plugin_locking_lock[request.args(0)]
-    if lock.created_by == auth.user_id:
-        lock.update_record(modified_on=request.now)
+    """
+    relock/<lock_id> or relock?ids=<lock_id>,<lock_id>,...
+    renews all the leases a page holds in one request
+    """
+    try:
+        lock_ids = [int(i) for i in (request.vars.ids or request.args(0) or '').split(',') if i]
+    except ValueError:
+        return 'false'
+    if lock_ids and plugin_locking_renew(lock_ids):
         return 'true'
     return 'false'
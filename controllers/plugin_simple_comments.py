@@ -3,7 +3,8 @@ def commenton():
     tablename, record_id = request.args(0), request.args(1)
     table=db.plugin_simple_comments_comment
     form=SQLFORM(table)
-    form.accepts(request.post_vars)
+    if form.accepts(request.post_vars):
+        plugin_simple_comments_count(tablename,record_id,+1)
     comments=db(table.tablename==tablename)\
         (table.record_id==record_id).select()
     return dict(form = form,comments=comments)
@@ -1,5 +1,3 @@
-import re
-
 db_tag = db.plugin_tagging_tag
 db_link = db.plugin_tagging_link
 
@@ -12,35 +10,41 @@ def index():
         raise HTTP(404)
     form = SQLFORM.factory(Field('tag_name'))
     if request.vars.tag_name:
-        for item in request.vars.tag_name.split(','):
-            tag_name = re.compile('\s+').sub(' ',item).strip()
-            if not tag_name[-1:]=='/': tag_name+='/'
-            tag_exists = tag = db(db_tag.name==tag_name).select().first()
-            if not tag_exists:
-                tag = db_tag.insert(name=tag_name, links=1)
-            link = db(db_link.tag==tag.id)\
-                (db_link.table_name==table_name)\
-                (db_link.record_id==record_id).select().first()
-            if not link:
-                db_link.insert(tag=tag.id,
-                               table_name=table_name,record_id=record_id)
-                if tag_exists:
-                    tag.update_record(links=tag.links+1)
-    for key in request.vars:
-        if key[:6]=='delete':
-            link_id=key[6:]
-            link=db_link[link_id]
-            del db_link[link_id]
-            db_tag[link.tag] = dict(links=db_tag[link.tag].links-1)
+        plugin_tagging_add(table_name,record_id,request.vars.tag_name)
+    link_ids = [key[6:] for key in request.vars if key[:6]=='delete']
+    if link_ids:
+        plugin_tagging_remove(table_name,record_id,link_ids)
     links = db(db_link.table_name==table_name)\
-              (db_link.record_id==record_id).select()\
-              .sort(lambda row: row.tag.name.upper())
+              (db_link.record_id==record_id)(db_link.tag==db_tag.id)\
+              .select(db_link.id,db_tag.name,orderby=db_tag.name.upper())
     return dict(links=links, form=form)
 
 def tag_cloud():
-    tags = db(db_tag.links>0).select()
-    if tags:
-        mc = max([tag.links for tag in tags])
+    try:
+        limit = min(max(int(request.vars.limit or 50),1),1000)
+        min_links = max(int(request.vars.min_links or 1),1)
+    except ValueError:
+        raise HTTP(400)
     return DIV(_class='plugin_tagging_tag_cloud',
-               *[SPAN(tag.name[:-1]+' ',_style='font-size:%sem' \
-                          % (0.8+1.0*tag.links/mc)) for tag in tags])
+               *[SPAN(name[:-1]+' ',_style='font-size:%sem' % size) \
+                     for name, size in plugin_tagging_cloud_data(limit,min_links)])
+
+def search():
+    """
+    plugin_tagging/search/<table_name>?tags=python,web&mode=all&page=0
+    returns the output of plugin_tagging_search as json
+    """
+    from gluon.serializers import json
+    table_name = request.args(0)
+    mode = request.vars.mode or 'all'
+    if not table_name in db.tables:
+        raise HTTP(404)
+    if not mode in ('all','any'):
+        raise HTTP(400)
+    try:
+        page = int(request.vars.page or 0)
+    except ValueError:
+        raise HTTP(400)
+    if page<0:
+        raise HTTP(400)
+    return json(plugin_tagging_search(table_name,request.vars.tags or '',mode,page))
@@ -2,15 +2,26 @@ def page():
     slug = request.args(0)
     w = db.plugin_wiki_page
     h = db.plugin_wiki_page_archive
-    page = db(w.slug==slug).select().first()
+    page = plugin_wiki_lookup(slug)
+    html = page and XML(page.html)
+    n, history_more = 20, False
+    try:
+        history_page = max(int(request.vars.history or 0),0)
+    except (ValueError,TypeError):
+        history_page = 0
+    onaccept = [plugin_wiki_archive,plugin_wiki_index_form,plugin_wiki_forget]
     if not page and plugin_wiki_editor:
         w.slug.default=slug
-        form=crud.create(w,onaccept=crud.archive,next=URL(r=request,args=request.args))
+        form=crud.create(w,onaccept=onaccept,next=URL(r=request,args=request.args))
         history=None
     elif page and auth.user_id==page.created_by or plugin_wiki_editor:
+        page = w[page.id]
         crud.settings.update_deletable=False
-        form=crud.update(w,page,onaccept=crud.archive,next=URL(r=request,args=request.args))
-        history = db(h.current_record==page.id).select(orderby=~h.modified_on)
+        form=crud.update(w,page,onaccept=onaccept,next=URL(r=request,args=request.args))
+        history = db(h.current_record==page.id).select(h.id,h.modified_on,h.modified_by,h.title,
+                                                       orderby=~h.id,limitby=(n*history_page,n*(history_page+1)+1))
+        history_more = len(history)>n
+        history = [item for item in history][:n]
     else:
         form=None
         history=None
@@ -18,4 +29,30 @@ def page():
         redirect(auth.settings.login_url)
     elif page and page.public and not page.active and not auth.user_id:
         page = None
-    return dict(form=form,page=page,history=history)
+    if page and not form:
+        plugin_wiki_not_modified(page)
+    return dict(form=form,page=page,html=html,history=history,
+                history_page=history_page,history_more=history_more)
+
+def revision():
+    w = db.plugin_wiki_page
+    h = db.plugin_wiki_page_archive
+    revision = db(h.id==request.args(0)).select(h.id,h.current_record,h.title,
+                                                  h.modified_on,h.modified_by).first()
+    page = revision and w[revision.current_record]
+    if not page:
+        raise HTTP(404)
+    if not (auth.user_id==page.created_by or plugin_wiki_editor):
+        redirect(auth.settings.login_url)
+    return dict(page=page,revision=revision,
+                html=plugin_wiki_render(plugin_wiki_revision(revision.id)))
+
+def search():
+    n = 10
+    try:
+        page = max(int(request.vars.page or 0),0)
+    except ValueError:
+        page = 0
+    count, results = plugin_wiki_search(request.vars.q or '',page,n)
+    return dict(q=request.vars.q or '',page=page,pages=(count+n-1)/n,
+                count=count,results=results)
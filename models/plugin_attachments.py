@@ -1,14 +1,322 @@
+import re
+plugin_attachments_regex = re.compile('^[0-9a-f]{64}\.[0-9a-fA-F]*\.\w+$')
+
+db.define_table('plugin_attachments_blob',
+                Field('hash',length=64),
+                Field('size','integer'),
+                Field('refs','integer',default=0))
+
 db.define_table('plugin_attachments_attachment',
                 Field('tablename',writable=False,readable=False),
                 Field('record_id','integer',writable=False,readable=False),
                 Field('name',requires=IS_NOT_EMPTY()),
-                Field('file','upload',requires=IS_NOT_EMPTY(),autodelete=True),
+                Field('file','upload',requires=IS_NOT_EMPTY(),length=255,
+                      custom_store=lambda file,filename,path=None: \
+                          plugin_attachments_store(file,filename),
+                      custom_retrieve=lambda name,path=None: \
+                          plugin_attachments_retrieve(name)),
                 Field('created_by',db.auth_user,default=auth.user_id or 1,
                       writable=False,readable=False),
                 Field('created_on','datetime',default=request.now,
                       writable=False,readable=False),
                 format='%(name)s')
 
+def plugin_attachments_indexes():
+    """
+    creates the unique index on blob hashes, once per process. Blob rows
+    of the same hash left by older versions are merged first into the
+    oldest one, which gets the sum of their references. If the index still
+    cannot be created this raises, because without it concurrent uploads
+    of the same content create duplicate blobs.
+    """
+    b = db.plugin_attachments_blob
+    first, n, refs = b.id.min(), b.id.count(), b.refs.sum()
+    for row in db(b.id>0).select(b.hash,first,refs,groupby=b.hash,having=n>1):
+        db(b.hash==row[b.hash])(b.id!=row[first]).delete()
+        db(b.id==row[first]).update(refs=row[refs])
+    if db._uri.startswith('mysql'): # no CREATE INDEX IF NOT EXISTS
+        if db.executesql("SHOW INDEX FROM plugin_attachments_blob WHERE Key_name='plugin_attachments_blob_hash';"):
+            return True
+        sql = 'CREATE UNIQUE INDEX plugin_attachments_blob_hash ON plugin_attachments_blob (hash);'
+    else:
+        sql = 'CREATE UNIQUE INDEX IF NOT EXISTS plugin_attachments_blob_hash ON plugin_attachments_blob (hash);'
+    try:
+        db.executesql(sql)
+    except Exception, e:
+        db.rollback()
+        raise RuntimeError, "plugin_attachments cannot create its unique index on blob hashes: %s" % e
+    return True
+
+if not request.env.web2py_runtime_gae:
+    cache.ram('plugin_attachments_indexes',plugin_attachments_indexes,None)
+
+def plugin_attachments_insert(insert):
+    """
+    calls insert() and returns its result, or None if a unique index rejects
+    the row because a concurrent request inserted it first; only that
+    conflict is caught. On PostgreSQL the insert runs in a savepoint so the
+    conflict does not abort the transaction (SQLite and MySQL only roll
+    back the failed statement). Each plugin keeps its own copy of this
+    helper so that it can be installed alone.
+    """
+    IntegrityError = getattr(db._adapter.driver,'IntegrityError',None) or Exception
+    savepoint = db._uri.startswith('postgres')
+    if savepoint:
+        db.executesql('SAVEPOINT plugin_attachments_insert;')
+    try:
+        value = insert()
+    except IntegrityError:
+        if savepoint:
+            db.executesql('ROLLBACK TO SAVEPOINT plugin_attachments_insert;')
+        return None
+    if savepoint:
+        db.executesql('RELEASE SAVEPOINT plugin_attachments_insert;')
+    return value
+
+def plugin_attachments_path(name):
+    """
+    the full path of the file stored under the upload name: content
+    addressed names (see plugin_attachments_store) live in
+    uploads/plugin_attachments/ab/cd/<sha256>, older ones in uploads/
+    """
+    import os
+    uploads = os.path.join(request.folder,'uploads')
+    if plugin_attachments_regex.match(name or ''):
+        digest = name[:64]
+        return os.path.join(uploads,'plugin_attachments',digest[:2],digest[2:4],digest)
+    return os.path.join(uploads,name)
+
+def plugin_attachments_store(file,filename,path=None):
+    """
+    custom_store of the file field. The upload is hashed (SHA-256) while it
+    is copied to a temporary file, which is then moved to its content
+    addressed location unless identical content is already stored; either
+    way the blob gains a reference. Returns <sha256>.<b16 filename>.<ext>.
+    """
+    import os, hashlib, base64, uuid
+    folder = os.path.join(request.folder,'uploads','plugin_attachments')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    temp = os.path.join(folder,'%s.tmp' % uuid.uuid4())
+    sha, size, dest = hashlib.sha256(), 0, open(temp,'wb')
+    try:
+        while True:
+            chunk = file.read(64*1024)
+            if not chunk:
+                break
+            sha.update(chunk)
+            size += len(chunk)
+            dest.write(chunk)
+    finally:
+        dest.close()
+    filename = os.path.basename(filename.replace('\\','/'))[-64:]
+    extension = filename.rfind('.')>0 and filename[filename.rfind('.')+1:].lower() or ''
+    extension = re.sub('\W','',extension)[:10] or 'txt'
+    name = '%s.%s.%s' % (sha.hexdigest(),base64.b16encode(filename),extension)
+    plugin_attachments_add(name,temp,size)
+    plugin_attachments_derive(name)
+    return name
+
+def plugin_attachments_add(name,temp,size):
+    """
+    moves the file temp to the blob of name, or deletes it if the blob
+    exists, and adds a reference to the blob. The blob row is created with
+    a guarded insert; if a concurrent upload of the same content created it
+    first, the reference is added to that row. Returns True if the content
+    was already stored.
+    """
+    import os, shutil
+    b = db.plugin_attachments_blob
+    digest, path = name[:64], plugin_attachments_path(name)
+    if os.path.exists(path):
+        os.unlink(temp)
+    else:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        shutil.move(temp,path)
+    if db(b.hash==digest).update(refs=b.refs+1):
+        return True
+    if plugin_attachments_insert(lambda: b.insert(hash=digest,size=size,refs=1)):
+        return False
+    db(b.hash==digest).update(refs=b.refs+1)
+    return True
+
+def plugin_attachments_filename(name):
+    """
+    the original filename encoded in the stored name
+    """
+    import base64
+    try:
+        if plugin_attachments_regex.match(name):
+            return base64.b16decode(name.split('.')[1],True)
+        return base64.b16decode(name.split('.')[-2],True)
+    except (TypeError,IndexError):
+        return name
+
+def plugin_attachments_retrieve(name,path=None):
+    """
+    custom_retrieve of the file field: (original filename, open file)
+    """
+    return plugin_attachments_filename(name), open(plugin_attachments_path(name),'rb')
+
+def plugin_attachments_release(name):
+    """
+    drops a reference to the blob of name and deletes the file when it was
+    the last one (older, non content addressed uploads are just deleted)
+    """
+    import os
+    b = db.plugin_attachments_blob
+    path = plugin_attachments_path(name)
+    if plugin_attachments_regex.match(name or ''):
+        digest = name[:64]
+        db(b.hash==digest).update(refs=b.refs-1)
+        if db(b.hash==digest)(b.refs>0).count():
+            return
+        db(b.hash==digest).delete()
+    for path in [path]+[plugin_attachments_lib.derived(path,kind) for kind in ('thumb','text')]:
+        if name and os.path.exists(path):
+            os.unlink(path)
+
+def plugin_attachments_before_delete(dbset):
+    """
+    _before_delete callback of plugin_attachments_attachment: releases the
+    files of the attachments about to be deleted, by any DAL delete
+    """
+    for row in dbset.select(db.plugin_attachments_attachment.file):
+        if row.file:
+            plugin_attachments_release(row.file)
+
+def plugin_attachments_before_update(dbset,fields):
+    """
+    _before_update callback of plugin_attachments_attachment: releases the
+    files replaced by the update
+    """
+    if 'file' in fields:
+        for row in dbset.select(db.plugin_attachments_attachment.file):
+            if row.file and row.file!=fields['file']:
+                plugin_attachments_release(row.file)
+
+# DALs with table callbacks release files on every delete and update;
+# older ones only through the crud callbacks below
+plugin_attachments_callbacks = hasattr(db.plugin_attachments_attachment,'_before_delete')
+if plugin_attachments_callbacks:
+    db.plugin_attachments_attachment._before_delete.append(plugin_attachments_before_delete)
+    db.plugin_attachments_attachment._before_update.append(plugin_attachments_before_update)
+
+def plugin_attachments_onaccept(form):
+    """
+    crud onaccept: releases the file replaced by a new upload. Does nothing
+    where the table callbacks do it; otherwise attachments updated or
+    deleted without crud keep their blobs referenced (until
+    plugin_attachments_release is called on their file)
+    """
+    if plugin_attachments_callbacks:
+        return
+    if form.record and form.record.file and form.record.file!=form.vars.file:
+        plugin_attachments_release(form.record.file)
+
+def plugin_attachments_ondelete(form):
+    """
+    crud ondelete: releases the file of the deleted attachment, unless the
+    table callbacks do it
+    """
+    if plugin_attachments_callbacks:
+        return
+    if form.record and form.record.file:
+        plugin_attachments_release(form.record.file)
+
+if not 'plugin_attachments_max_age' in globals():
+    plugin_attachments_max_age = 365*24*3600
+if not 'plugin_attachments_sendfile' in globals():
+    # None, 'X-Sendfile' (apache, lighttpd) or 'X-Accel-Redirect' (nginx)
+    plugin_attachments_sendfile = None
+if not 'plugin_attachments_sendfile_location' in globals():
+    # the internal nginx location that maps to the uploads folder
+    plugin_attachments_sendfile_location = '/_plugin_attachments/'
+if not 'plugin_attachments_chunk_size' in globals():
+    plugin_attachments_chunk_size = 64*1024
+if not 'plugin_attachments_workers' in globals():
+    plugin_attachments_workers = 2
+if not 'plugin_attachments_thumbnail_size' in globals():
+    plugin_attachments_thumbnail_size = (128,128)
+if not 'plugin_attachments_preview_length' in globals():
+    plugin_attachments_preview_length = 2048
+
+plugin_attachments_lib = local_import('plugin_attachments')
+
+def plugin_attachments_derive(name):
+    """
+    queues the thumbnail or text preview of the file stored under name to
+    the process pool of this web2py process (created on first use, kept in
+    cache.ram); the request does not wait for it
+    """
+    if request.env.web2py_runtime_gae:
+        return
+    extension = name[name.rfind('.')+1:]
+    if not plugin_attachments_lib.kind(extension):
+        return
+    pool = cache.ram('plugin_attachments_pool',
+                     lambda: plugin_attachments_lib.pool(plugin_attachments_workers),None)
+    if pool:
+        pool.apply_async(plugin_attachments_lib.derive,
+                         (plugin_attachments_path(name),extension,
+                          plugin_attachments_thumbnail_size,plugin_attachments_preview_length))
+
+def plugin_attachments_serve(path,etag,content_type=None,filename=None):
+    """
+    raises the HTTP response that serves the file at path, streamed in
+    chunks or handed to the front proxy (plugin_attachments_sendfile).
+    Stored files never change, so etag (derived from the stored name) is
+    the only validator and responses can be cached for
+    plugin_attachments_max_age seconds. A single "Range: bytes=..." is
+    honored, unless If-Range names another version. content_type defaults
+    to the one of the extension of path, which content addressed paths
+    do not have, so callers pass the one of the stored name. filename,
+    if given, is sent as the inline Content-Disposition filename.
+    """
+    import os, re
+    from gluon.contenttype import contenttype
+    from gluon.streamer import streamer
+    if not os.path.isfile(path):
+        raise HTTP(404)
+    size = os.path.getsize(path)
+    headers = {'Content-Type':content_type or contenttype(path),
+               'ETag':etag,
+               'Accept-Ranges':'bytes',
+               'Cache-Control':'public, max-age=%i' % plugin_attachments_max_age}
+    if filename:
+        import urllib
+        ascii = re.sub('[^\w\-. ]','_',filename.decode('utf8','ignore')).encode('ascii','replace')
+        headers['Content-Disposition'] = 'inline; filename="%s"; filename*=UTF-8\'\'%s' % \
+            (ascii,urllib.quote(filename))
+    if etag in [tag.strip() for tag in (request.env.http_if_none_match or '').split(',')]:
+        raise HTTP(304,**headers)
+    if plugin_attachments_sendfile=='X-Sendfile':
+        headers['X-Sendfile'] = path
+        raise HTTP(200,'',**headers)
+    elif plugin_attachments_sendfile=='X-Accel-Redirect':
+        folder = os.path.dirname(plugin_attachments_path('x'))
+        headers['X-Accel-Redirect'] = plugin_attachments_sendfile_location+\
+            path[len(folder):].lstrip(os.sep).replace(os.sep,'/')
+        raise HTTP(200,'',**headers)
+    match = re.match('^bytes=(\d*)-(\d*)$',(request.env.http_range or '').strip())
+    if match and request.env.http_if_range in (None,etag) and match.group(1)+match.group(2):
+        start, stop = match.group(1), match.group(2)
+        if not start:
+            start, stop = max(size-int(stop),0), size-1
+        else:
+            start, stop = int(start), min(int(stop or size-1),size-1)
+        if start>stop or start>=size:
+            headers['Content-Range'] = 'bytes */%i' % size
+            raise HTTP(416,'',**headers)
+        headers['Content-Range'] = 'bytes %i-%i/%i' % (start,stop,size)
+        headers['Content-Length'] = str(stop-start+1)
+        stream = open(path,'rb')
+        stream.seek(start)
+        raise HTTP(206,streamer(stream,plugin_attachments_chunk_size,stop-start+1),**headers)
+    headers['Content-Length'] = str(size)
+    raise HTTP(200,streamer(open(path,'rb'),plugin_attachments_chunk_size),**headers)
+
 class PluginAttachments:
     def __init__(self,tablename,record_id=0,caption='Attachments',close="Close",id=None,width=70,height=70):
         import uuid
@@ -22,3 +330,57 @@ class PluginAttachments:
         self.source=URL(r=request,c='plugin_attachments',f='index',args=(tablename,record_id))
     def xml(self):
         return '<div id="%(id)s" style="display:none"><div style="position:fixed;top:0%%;left:0%%;width:100%%;height:100%%;background-color:black;z-index:1001;-moz-opacity:0.8;opacity:.80;opacity:0.8;"></div><div style="position:fixed;top:%(top)s%%;left:%(left)s%%;width:%(width)s%%;height:%(height)s%%;padding:16px;border:2px solid black;background-color:white;opacity:1.0;z-index:1002;overflow:auto;-moz-border-radius: 10px; -webkit-border-radius: 10px;"><span style="font-weight:bold">%(title)s</span><span style="float:right">[<a href="#" onclick="jQuery(\'#%(id)s\').hide();return false;">%(close)s</a>]</span><hr/><div style="width:100%%;height:90%%;" id="c%(id)s"><iframe id="attachments_modal_content" style="width:100%%;height:100%%;border:0">loading...</iframe></div></div></div><a href="#" onclick="jQuery(\'#attachments_modal_content\').attr(\'src\',\'%(source)s\');jQuery(\'#%(id)s\').fadeIn(); return false" style="padding: 0 10px 0 10px; position: fixed; right:0; bottom:0; background: #999; color: white; z-index: 100; clear: both;">%(title)s</a>' % dict(title=self.caption,source=self.source,close=self.close,id=self.id,left=(100-self.width)/2,top=(100-self.height)/2,width=self.width,height=self.height)
+
+def plugin_attachments_dedup():
+    """
+    moves the uploads stored before content addressing into the blob store,
+    sharing identical files, for example from a shell:
+
+        python web2py.py -S <app> -M
+        >>> print plugin_attachments_dedup()
+
+    Each file is copied into the store and the row committed before the
+    original is deleted, so an interruption leaves every row pointing at a
+    file that exists; running it again resumes. It commits as it goes.
+    Returns dict(files=number of files moved, saved=bytes saved).
+    """
+    import os, hashlib, base64, uuid, shutil
+    a = db.plugin_attachments_attachment
+    folder = os.path.join(request.folder,'uploads','plugin_attachments')
+    files = saved = 0
+    for row in db(a.id>0).select(a.id,a.file):
+        if not row.file or plugin_attachments_regex.match(row.file):
+            continue
+        old = plugin_attachments_path(row.file)
+        if not os.path.exists(old):
+            continue
+        filename, stream = plugin_attachments_retrieve(row.file)
+        stream.close()
+        filename = filename[-64:]
+        sha, size, source = hashlib.sha256(), os.path.getsize(old), open(old,'rb')
+        try:
+            while True:
+                chunk = source.read(64*1024)
+                if not chunk:
+                    break
+                sha.update(chunk)
+        finally:
+            source.close()
+        extension = re.sub('\W','',row.file[row.file.rfind('.')+1:])[:10] or 'txt'
+        name = '%s.%s.%s' % (sha.hexdigest(),base64.b16encode(filename),extension)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        temp = os.path.join(folder,'%s.tmp' % uuid.uuid4())
+        shutil.copyfile(old,temp)
+        duplicate = plugin_attachments_add(name,temp,size)
+        # update_naive skips plugin_attachments_before_update, which would
+        # delete the original before the commit
+        dbset = db(a.id==row.id)
+        getattr(dbset,'update_naive',dbset.update)(file=name)
+        db.commit()
+        if os.path.exists(old):
+            os.unlink(old)
+        if duplicate:
+            saved += size
+        files += 1
+    return dict(files=files,saved=saved)
@@ -1,11 +1,61 @@
+if not 'plugin_datatable_max_length' in globals():
+    plugin_datatable_max_length = 1000
+
 def plugin_datatable_include():
     response.files.append(URL(r=request,c='static',f='plugin_datatable/jquery.dataTables.min.js'))
     response.files.append(URL(r=request,c='static',f='plugin_datatable/jquery.dataTables.css'))
 
-def plugin_datatable(rows,**attributes):
+def plugin_datatable(rows,columns=None,**attributes):
+    """
+    {{=plugin_datatable(db(db.mytable.id>0).select(),_class='datatable')}}
+    renders all the rows and lets dataTables page them in the browser;
+    {{=plugin_datatable(db(db.mytable.id>0),columns=['name'],_class='datatable')}}
+    (a Set of one table) only renders the header and the pages are
+    served by plugin_datatable/data as the user browses, sorts, searches
+    """
     if not '_class' in attributes:
         raise SyntaxError, "plugin_database needs a _class attribute"
-    return TAG[''](SCRIPT("jQuery(document).ready(function() {jQuery('.%s').dataTable();});" % attributes['_class']),
-                   SQLTABLE(rows,**attributes))
+    if not hasattr(rows,'query'): # Rows rather than a Set
+        if columns:
+            attributes['columns'] = columns
+        return TAG[''](SCRIPT("jQuery(document).ready(function() {jQuery('.%s').dataTable();});" % attributes['_class']),
+                       SQLTABLE(rows,**attributes))
+    import hashlib
+    tablenames = rows.db._adapter.tables(rows.query)
+    if len(tablenames)!=1:
+        raise SyntaxError, "plugin_datatable needs a Set of one table"
+    table = rows.db[tablenames[0]]
+    columns = [name.split('.')[-1] for name in columns or []] or \
+        [name for name in table.fields if table[name].readable]
+    source = (table._tablename,columns,str(rows.query))
+    token = hashlib.md5(repr(source)).hexdigest()
+    if not session.plugin_datatable:
+        session.plugin_datatable = {}
+    session.plugin_datatable[token] = source
+    url = URL(r=request,c='plugin_datatable',f='data',args=token)
+    script = "jQuery(document).ready(function() {jQuery('.%s').dataTable({'bProcessing':true,'bServerSide':true,'sAjaxSource':'%s'});});" % (attributes['_class'],url)
+    return TAG[''](SCRIPT(script),
+                   TABLE(THEAD(TR(*[TH(table[name].label) for name in columns])),
+                         TBODY(),**attributes))
+
+def plugin_datatable_serializer(table,columns):
+    """
+    returns a function that turns the records of a page into the json of
+    the aaData of a dataTables response. Cells are built a column at a
+    time, so each represent is looked up once per page, and the page is
+    dumped with a single json call.
+    """
+    from gluon.serializers import json
+    from gluon.html import xmlescape
+    represents = [table[name].represent for name in columns]
+    def serialize(records):
+        values = []
+        for name, represent in zip(columns,represents):
+            column = [record[name] for record in records]
+            if represent:
+                column = map(represent,column)
+            values.append([xmlescape(value,False) for value in column])
+        return json(map(list,zip(*values)))
+    return serialize
 
 plugin_datatable_include()
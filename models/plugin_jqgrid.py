@@ -5,6 +5,229 @@ for _f in ['plugin_jqgrid/ui.jqgrid.css',
            'plugin_jqgrid/jquery.jqGrid.min.js']:
     response.files.append(URL(r=request,c='static',f=_f))
 
+if not 'plugin_jqgrid_count_ttl' in globals():
+    plugin_jqgrid_count_ttl = 60
+if not 'plugin_jqgrid_keyset_ttl' in globals():
+    plugin_jqgrid_keyset_ttl = 300
+if not 'plugin_jqgrid_cache' in globals():
+    plugin_jqgrid_cache = cache.ram
+# 'tablename.fieldname' of the indexed string fields with a byte order
+# (C/binary) collation, where 'bw' searches can be turned into ranges
+if not 'plugin_jqgrid_prefix_indexed' in globals():
+    plugin_jqgrid_prefix_indexed = []
+
+# tablename -> seconds the data responses of that table are cached for,
+# filled by plugin_jqgrid_cacheable
+plugin_jqgrid_cached = {}
+
+def plugin_jqgrid_cacheable(table,ttl=60):
+    """
+    opts table in to the data response cache, for example in a model that
+    runs after this one:
+
+        plugin_jqgrid_cacheable(db.mytable,ttl=30)
+
+    responses are keyed by the table version, which inserts, updates and
+    deletes bump when the DAL has _after_insert/update/delete callbacks;
+    otherwise (and for changes made by other processes) ttl is the bound
+    on stale pages.
+    """
+    tablename = table._tablename
+    plugin_jqgrid_cached[tablename] = ttl
+    if hasattr(table,'_after_insert'):
+        table._after_insert.append(lambda fields,id: plugin_jqgrid_bump(tablename))
+        table._after_update.append(lambda dbset,fields: plugin_jqgrid_bump(tablename))
+        table._after_delete.append(lambda dbset: plugin_jqgrid_bump(tablename))
+
+def plugin_jqgrid_version(tablename):
+    return plugin_jqgrid_cache('plugin_jqgrid_version_%s' % tablename,lambda: 0,None)
+
+def plugin_jqgrid_bump(tablename):
+    """
+    invalidates the cached data responses, counts and page boundaries of
+    tablename
+    """
+    plugin_jqgrid_version(tablename)
+    plugin_jqgrid_cache.increment('plugin_jqgrid_version_%s' % tablename)
+    if plugin_jqgrid_cache==cache.ram:
+        cache.ram.clear(regex='^plugin_jqgrid_(data|count|keys)_%s_' % tablename)
+
+def plugin_jqgrid_signature(*items):
+    """
+    a short key for cache entries that depend on items (queries, names)
+    """
+    import hashlib
+    return hashlib.md5('|'.join([str(item) for item in items])).hexdigest()
+
+def plugin_jqgrid_count(dbset,table):
+    """
+    dbset.count() cached for plugin_jqgrid_count_ttl seconds per query and
+    table version, so that turning pages does not count the whole table
+    every time
+    """
+    key = 'plugin_jqgrid_count_%s_%s_%s' % (table._tablename,plugin_jqgrid_version(table._tablename),
+                                            plugin_jqgrid_signature(dbset.query))
+    return cache.ram(key,dbset.count,plugin_jqgrid_count_ttl)
+
+def plugin_jqgrid_page(dbset,table,fields,sidx,sord,page,rows):
+    """
+    selects page (from 1) of rows records of dbset ordered by (sidx, id).
+    The (sidx, id) of the last record of every page served is cached per
+    query, order and table version, so the page after it is a keyset seek
+    instead of a limitby offset; pages with no cached boundary use the
+    offset, and so does a sidx column that has NULLs, which would fall out
+    of the seek.
+    """
+    key = 'plugin_jqgrid_keys_%s_%s_%s' % (table._tablename,plugin_jqgrid_version(table._tablename),
+                                           plugin_jqgrid_signature(dbset.query,sidx,sord,rows))
+    boundaries = cache.ram(key,lambda: {},plugin_jqgrid_keyset_ttl)
+    field, id, desc = table[sidx], table._id, sord=='desc'
+    names = [f.name for f in fields]
+    fields = fields+[f for f in [id,field] if not f.name in names]
+    if sidx==id.name:
+        orderby = desc and ~id or id
+    elif desc:
+        orderby = ~field|~id
+    else:
+        orderby = field|id
+    if not 'nulls' in boundaries:
+        boundaries['nulls'] = not (field.notnull or sidx==id.name) and \
+            bool(dbset(field==None).select(id,limitby=(0,1)))
+    boundary = not boundaries['nulls'] and boundaries.get(page-1)
+    # the seek goes before the query of dbset: given id>0 AND id>n SQLite
+    # only uses the first range on the rowid
+    if boundary and sidx==id.name:
+        dbset = table._db(desc and id<boundary[1] or id>boundary[1])(dbset.query)
+        limitby = (0,rows)
+    elif boundary and desc:
+        dbset = table._db((field<boundary[0])|((field==boundary[0])&(id<boundary[1])))(dbset.query)
+        limitby = (0,rows)
+    elif boundary:
+        dbset = table._db((field>boundary[0])|((field==boundary[0])&(id>boundary[1])))(dbset.query)
+        limitby = (0,rows)
+    else:
+        limitby = (rows*(page-1),rows*page)
+    records = dbset.select(orderby=orderby,limitby=limitby,*fields)
+    if records and records[-1][sidx] is not None:
+        boundaries[page] = (records[-1][sidx],records[-1][id.name])
+    return records
+
+def plugin_jqgrid_prefix(field,prefix):
+    """
+    field starts with prefix. For the fields in plugin_jqgrid_prefix_indexed
+    this is also a range, so that their index can be used (the LIKE is kept
+    to be exact, the range narrows); elsewhere a range could drop matches,
+    under a locale collation or where LIKE ignores case (SQLite).
+    """
+    if isinstance(prefix,unicode):
+        prefix = prefix.encode('utf8')
+    indexed = '%s.%s' % (field.tablename,field.name) in plugin_jqgrid_prefix_indexed
+    if field.type!='string' or not indexed or not prefix or prefix[-1]=='\xff':
+        return field.like(prefix+'%')
+    upper = prefix[:-1]+chr(ord(prefix[-1])+1)
+    return (field>=prefix)&(field<upper)&field.like(prefix+'%')
+
+plugin_jqgrid_operators = {
+    'eq':lambda a,b: a==b,
+    'ne':lambda a,b: a!=b,
+    'nq':lambda a,b: a!=b,
+    'gt':lambda a,b: a>b,
+    'ge':lambda a,b: a>=b,
+    'lt':lambda a,b: a<b,
+    'le':lambda a,b: a<=b,
+    'bw':plugin_jqgrid_prefix,
+    'bn':lambda a,b: ~a.like(b+'%'),
+    'ew':lambda a,b: a.like('%'+b),
+    'en':lambda a,b: ~a.like('%'+b),
+    'cn':lambda a,b: a.like('%'+b+'%'),
+    'nc':lambda a,b: ~a.like('%'+b+'%'),
+    'in':lambda a,b: a.belongs(b.split()),
+    'ni':lambda a,b: ~a.belongs(b.split()),
+    'nu':lambda a,b: a==None,
+    'nn':lambda a,b: a!=None}
+
+def plugin_jqgrid_plan(table,filters):
+    """
+    (plan, values) for a jqGrid filters object, that is
+    {"groupOp":"AND","rules":[{"field":..,"op":..,"data":..}],"groups":[..]}.
+    The plan is (groupOp, ((fieldname, op), ...), (subplans, ...)): names
+    only, checked on every call against the fields of table readable in
+    this request; values are the rule data in plan order. Rule data are
+    turned into utf8 strings, numbers from the json included.
+    Raises HTTP(400) for malformed filters, unknown fields or operators.
+    """
+    values = []
+    def value(data):
+        if data is None:
+            return ''
+        elif isinstance(data,unicode):
+            return data.encode('utf8')
+        elif isinstance(data,(list,dict)):
+            raise HTTP(400)
+        return str(data)
+    def shape(group,depth=0):
+        if not isinstance(group,dict) or depth>10:
+            raise HTTP(400)
+        rules = group.get('rules') or []
+        if not isinstance(rules,list) or [rule for rule in rules if not isinstance(rule,dict)]:
+            raise HTTP(400)
+        values.extend([value(rule.get('data')) for rule in rules])
+        return ((value(group.get('groupOp')) or 'AND').upper(),
+                tuple([(value(rule.get('field')),value(rule.get('op')) or 'eq') for rule in rules]),
+                tuple([shape(g,depth+1) for g in group.get('groups') or []]))
+    def check(plan):
+        groupop, rules, groups = plan
+        if not groupop in ('AND','OR'):
+            raise HTTP(400)
+        for name, op in rules:
+            if not name in table.fields or not table[name].readable or \
+                    not op in plugin_jqgrid_operators:
+                raise HTTP(400)
+        for group in groups:
+            check(group)
+    plan = shape(filters)
+    check(plan)
+    return plan, values
+
+def plugin_jqgrid_filter(table,plan,values):
+    """
+    the DAL query of a plan from plugin_jqgrid_plan and its values, or None
+    if there are no rules
+    """
+    values = iter(values)
+    def compile(plan):
+        groupop, rules, groups = plan
+        queries = [plugin_jqgrid_operators[op](table[name],values.next()) for name, op in rules]
+        queries += [query for query in [compile(group) for group in groups] if query]
+        if not queries:
+            return None
+        elif groupop=='OR':
+            return reduce(lambda a,b: a|b,queries)
+        return reduce(lambda a,b: a&b,queries)
+    return compile(plan)
+
+def plugin_jqgrid_serializer(table,columns):
+    """
+    returns a function that turns a record into the json of its jqGrid row.
+    The represent of each column is looked up once here rather than once
+    per cell; columns without one are only escaped, or only turned into
+    strings when they hold numbers or booleans, which need no escaping.
+    """
+    from gluon.serializers import json
+    from gluon.html import xmlescape
+    cells = []
+    for name in columns:
+        represent = table[name].represent
+        if represent:
+            cells.append((name,lambda value,r=represent: xmlescape(r(value),False)))
+        elif table[name].type in ('id','integer','bigint','double','boolean'):
+            cells.append((name,str))
+        else:
+            cells.append((name,lambda value: xmlescape(value,False)))
+    def serialize(record):
+        return json({'id':record.id,'cell':[cell(record[name]) for name, cell in cells]})
+    return serialize
+
 def plugin_jqgrid(table,fieldname=None,fieldvalue=None,col_widths={},
                   _id=None,columns=None,col_width=80,width=700,height=300):
     """
@@ -30,7 +253,7 @@ def plugin_jqgrid(table,fieldname=None,fieldvalue=None,col_widths={},
                              fieldvalue=fieldvalue,
                              ))
     script="""
-jQuery(document).ready(function(){jQuery("#%(id)s").jqGrid({ url:'%(callback)s', datatype: "json", colNames: %(colnames)s,colModel:%(colmodel)s, rowNum:10, rowList:[20,50,100], pager: '#%(id)s_pager', viewrecords: true,height:%(height)s});jQuery("#%(id)s").jqGrid('navGrid','#%(id)s_pager',{search:true,add:false,edit:false,del:false});jQuery("#%(id)s").setGridWidth(%(width)s,false);});
+jQuery(document).ready(function(){jQuery("#%(id)s").jqGrid({ url:'%(callback)s', datatype: "json", colNames: %(colnames)s,colModel:%(colmodel)s, rowNum:10, rowList:[20,50,100], pager: '#%(id)s_pager', viewrecords: true,height:%(height)s});jQuery("#%(id)s").jqGrid('navGrid','#%(id)s_pager',{search:true,add:false,edit:false,del:false},{},{},{},{multipleSearch:true});jQuery("#%(id)s").setGridWidth(%(width)s,false);});
 """ % dict(callback=callback,colnames=json(colnames),
            colmodel=json(colmodel),id=_id,height=height,width=width)
     return TAG[''](TABLE(_id=_id),
@@ -3,6 +3,11 @@ In the page you want to lock
 
 {{=plugin_locking('tablename',record_id)}}
 
+Leases are stored in the database; for single process deployments set
+
+plugin_locking_backend = 'memory'
+
+before this model runs to keep them in memory instead.
 """
 
 db.define_table('plugin_locking_lock',
@@ -12,19 +17,220 @@ db.define_table('plugin_locking_lock',
                 Field('created_on','datetime',default=request.now),
                 Field('modified_on','datetime',default=request.now))
 
+if not 'plugin_locking_backend' in globals():
+    plugin_locking_backend = 'db'
+if not 'plugin_locking_sweep_after' in globals():
+    plugin_locking_sweep_after = 3600
+
+def plugin_locking_indexes():
+    """
+    creates the unique (tablename, record_id) index that makes sure at
+    most one lease exists per record, once per process. Duplicate leases
+    left by the select-then-insert of older versions are deleted first
+    (the oldest row of each record is kept). If the index still cannot be
+    created this raises, because without it two users can be granted the
+    same record.
+    """
+    if request.env.web2py_runtime_gae:
+        return
+    t = db.plugin_locking_lock
+    first, n = t.id.min(), t.id.count()
+    for row in db(t.id>0).select(t.tablename,t.record_id,first,
+                                 groupby=t.tablename|t.record_id,having=n>1):
+        db(t.tablename==row[t.tablename])(t.record_id==row[t.record_id])\
+            (t.id!=row[first]).delete()
+    if db._uri.startswith('mysql'): # no CREATE INDEX IF NOT EXISTS
+        if db.executesql("SHOW INDEX FROM plugin_locking_lock WHERE Key_name='plugin_locking_lock_record';"):
+            return True
+        sql = 'CREATE UNIQUE INDEX plugin_locking_lock_record ON plugin_locking_lock (tablename, record_id);'
+    else:
+        sql = 'CREATE UNIQUE INDEX IF NOT EXISTS plugin_locking_lock_record ON plugin_locking_lock (tablename, record_id);'
+    try:
+        db.executesql(sql)
+    except Exception, e:
+        db.rollback()
+        raise RuntimeError, "plugin_locking cannot create its unique index: %s" % e
+    return True
+
+cache.ram('plugin_locking_indexes',plugin_locking_indexes,None)
+
+def plugin_locking_insert(insert,db=db):
+    """
+    calls insert() and returns its result, or None if a unique index rejects
+    the row because a concurrent request inserted it first; only that
+    conflict is caught. On PostgreSQL the insert runs in a savepoint so the
+    conflict does not abort the transaction (SQLite and MySQL only roll
+    back the failed statement). Each plugin keeps its own copy of this
+    helper so that it can be installed alone.
+    """
+    IntegrityError = getattr(db._adapter.driver,'IntegrityError',None) or Exception
+    savepoint = db._uri.startswith('postgres')
+    if savepoint:
+        db.executesql('SAVEPOINT plugin_locking_insert;')
+    try:
+        value = insert()
+    except IntegrityError:
+        if savepoint:
+            db.executesql('ROLLBACK TO SAVEPOINT plugin_locking_insert;')
+        return None
+    if savepoint:
+        db.executesql('RELEASE SAVEPOINT plugin_locking_insert;')
+    return value
+
+class PluginLockingDAL:
+    """
+    leases stored in plugin_locking_lock, one row per (tablename, record_id).
+    A lease is taken over with a single conditional UPDATE (compare and
+    set on the row) and created with an INSERT that the unique index
+    rejects if another request created it first.
+    """
+    def __init__(self,db):
+        self.db=db
+        self.table=db.plugin_locking_lock
+    def acquire(self,tablename,record_id,user_id,locktime,expiration,now):
+        import datetime
+        t = self.table
+        lock = self.db(t.tablename==tablename)(t.record_id==record_id).select(t.id).first()
+        if not lock:
+            return plugin_locking_insert(lambda: t.insert(tablename=tablename,record_id=record_id,
+                                                          created_by=user_id,created_on=now,
+                                                          modified_on=now),self.db)
+        free = (t.created_by==user_id)|\
+            (t.modified_on<now-datetime.timedelta(seconds=locktime))|\
+            (t.created_on<now-datetime.timedelta(seconds=expiration))
+        if self.db(t.id==lock.id)(free).update(created_by=user_id,
+                                               created_on=now,modified_on=now):
+            return lock.id
+        return None
+    def renew(self,lock_ids,user_id,now):
+        t = self.table
+        return self.db(t.id.belongs(lock_ids))(t.created_by==user_id)\
+            .update(modified_on=now)
+    def sweep(self,seconds,now):
+        import datetime
+        t = self.table
+        return self.db(t.modified_on<now-datetime.timedelta(seconds=seconds)).delete()
+
+class PluginLockingMemory:
+    """
+    leases kept in the memory of the process, same interface as
+    PluginLockingDAL, for single process deployments
+    """
+    def __init__(self):
+        import threading
+        self.mutex = threading.Lock()
+        self.leases = {} # (tablename, record_id) -> [id, user_id, created_on, modified_on]
+        self.keys = {} # id -> (tablename, record_id)
+        self.counter = 0
+    def acquire(self,tablename,record_id,user_id,locktime,expiration,now):
+        import datetime
+        key = (tablename,int(record_id))
+        self.mutex.acquire()
+        try:
+            lease = self.leases.get(key)
+            if lease and lease[1]!=user_id \
+                    and lease[3]+datetime.timedelta(seconds=locktime)>now \
+                    and lease[2]+datetime.timedelta(seconds=expiration)>now:
+                return None
+            if lease:
+                lease[1:] = [user_id,now,now]
+            else:
+                self.counter += 1
+                self.leases[key] = lease = [self.counter,user_id,now,now]
+                self.keys[self.counter] = key
+            return lease[0]
+        finally:
+            self.mutex.release()
+    def renew(self,lock_ids,user_id,now):
+        n = 0
+        self.mutex.acquire()
+        try:
+            for lock_id in lock_ids:
+                lease = self.leases.get(self.keys.get(int(lock_id)))
+                if lease and lease[1]==user_id:
+                    lease[3] = now
+                    n += 1
+        finally:
+            self.mutex.release()
+        return n
+    def sweep(self,seconds,now):
+        import datetime
+        n = 0
+        self.mutex.acquire()
+        try:
+            for key, lease in self.leases.items():
+                if lease[3]+datetime.timedelta(seconds=seconds)<now:
+                    del self.leases[key]
+                    del self.keys[lease[0]]
+                    n += 1
+        finally:
+            self.mutex.release()
+        return n
+
+def plugin_locking_leases():
+    """
+    returns the lease backend selected by plugin_locking_backend
+    """
+    if plugin_locking_backend=='memory':
+        return cache.ram('plugin_locking_memory',lambda: PluginLockingMemory(),None)
+    return PluginLockingDAL(db)
+
+def plugin_locking_state():
+    """
+    per process heartbeat state: leases maps a lock id to
+    [user_id, skip renewals until, locktime, expires on]; written and
+    skipped count the renewals that did or did not reach the backend
+    """
+    return cache.ram('plugin_locking_state',
+                     lambda: dict(leases={},written=0,skipped=0),None)
+
+def plugin_locking_stats():
+    state = plugin_locking_state()
+    return dict(written=state['written'],skipped=state['skipped'])
+
+def plugin_locking_renew(lock_ids):
+    """
+    renews the leases of the current user in lock_ids with one UPDATE.
+    A lease this process persisted less than half a locktime ago is not
+    written again: it cannot have expired or been taken over since.
+    Returns True if every lease is still held.
+    """
+    import datetime
+    state = plugin_locking_state()
+    leases, due = state['leases'], []
+    for lock_id in lock_ids:
+        lease = leases.get(lock_id)
+        if not (lease and lease[0]==auth.user_id and lease[1]>request.now):
+            due.append(lock_id)
+    state['skipped'] += len(lock_ids)-len(due)
+    if not due:
+        return True
+    written = plugin_locking_leases().renew(due,auth.user_id,request.now)
+    state['written'] += written
+    if written<len(due):
+        return False
+    for lock_id in due:
+        if lock_id in leases:
+            lease = leases[lock_id]
+            lease[1] = min(request.now+datetime.timedelta(seconds=lease[2]/2.0),lease[3])
+    return True
+
 def plugin_locking(
     tablename,record_id=0,
     locktime=60, expiration=3600):
     import datetime
-    locks = db(db.plugin_locking_lock.tablename==tablename)\
-        (db.plugin_locking_lock.record_id==record_id)
-    lock = locks.select().first()
-    if lock and lock.created_by!=auth.user_id \
-            and lock.modified_on+datetime.timedelta(seconds=locktime)>request.now \
-            and lock.created_on+datetime.timedelta(seconds=expiration)>request.now:
+    leases, state = plugin_locking_leases(), plugin_locking_state()
+    def sweep():
+        for lock_id, lease in state['leases'].items():
+            if lease[3]<request.now:
+                del state['leases'][lock_id]
+        return leases.sweep(max(plugin_locking_sweep_after,expiration),request.now)
+    cache.ram('plugin_locking_sweep',sweep,600)
+    lock_id = leases.acquire(tablename,record_id,auth.user_id,locktime,expiration,request.now)
+    if not lock_id:
         return None
-    else:
-        if lock: locks.delete()
-        lock_id = db.plugin_locking_lock.insert(tablename=tablename,
-                                           record_id=record_id)
-        return SCRIPT("""function plugin_locking(){ajax("%(callback)s",[],false);setTimeout("plugin_locking()",%(delta)s);};setTimeout("plugin_locking()",%(delta)s);""" % dict(callback=URL(r=request,c='plugin_locking',f='relock',args=lock_id),delta=locktime*300))
+    state['leases'][lock_id] = [auth.user_id,
+                                request.now+datetime.timedelta(seconds=locktime/2.0),
+                                locktime,
+                                request.now+datetime.timedelta(seconds=expiration)]
+    return SCRIPT("""if(!window.plugin_locking_ids){window.plugin_locking_ids=[];setInterval(function(){jQuery.post("%(callback)s",{ids:plugin_locking_ids.join(',')});},%(delta)s);};plugin_locking_ids.push(%(lock_id)s);""" % dict(callback=URL(r=request,c='plugin_locking',f='relock'),lock_id=lock_id,delta=locktime*300))
@@ -2,6 +2,7 @@ db.define_table('plugin_rating_master',
    Field('tablename'),
    Field('record_id','integer'),
    Field('rating','double'),
+   Field('rating_sum','double',default=0),
    Field('counter','integer'))
 
 db.define_table('plugin_rating_aux',
@@ -14,12 +15,270 @@ response.files.append(URL(r=request,c='static',
 response.files.append(URL(r=request,c='static',
                           f='plugin_rating/jquery.rating.js'))
 
-def plugin_rating(tablename,record_id=0):
-    row=db(db.plugin_rating_master.tablename==tablename)\
-        (db.plugin_rating_master.record_id==record_id).select().first()
-    if not row:
-        rating = 2
+def plugin_rating_upgrade():
+    """
+    creates the unique indexes that make voting race free and fills
+    rating_sum for master rows stored before it existed, once per process.
+    Duplicates left by the select-then-insert of older versions are merged
+    first: the votes of duplicate master rows move to the oldest one, only
+    the latest vote of each user is kept, and the totals of the merged
+    masters are recomputed from their votes. If an index still cannot be
+    created this raises, since votes would no longer be race free.
+    """
+    if request.env.web2py_runtime_gae:
+        return True
+    pm, pa = db.plugin_rating_master, db.plugin_rating_aux
+    db(pm.rating_sum==None).update(rating_sum=pm.rating*pm.counter)
+    merged = set()
+    first, n = pm.id.min(), pm.id.count()
+    for row in db(pm.id>0).select(pm.tablename,pm.record_id,first,
+                                  groupby=pm.tablename|pm.record_id,having=n>1):
+        others = db(pm.tablename==row[pm.tablename])(pm.record_id==row[pm.record_id])\
+            (pm.id!=row[first])
+        db(pa.master.belongs([other.id for other in others.select(pm.id)]))\
+            .update(master=row[first])
+        others.delete()
+        merged.add(row[first])
+    last, n = pa.id.max(), pa.id.count()
+    for row in db(pa.created_by!=None).select(pa.master,pa.created_by,last,
+                                              groupby=pa.master|pa.created_by,having=n>1):
+        db(pa.master==row[pa.master])(pa.created_by==row[pa.created_by])\
+            (pa.id!=row[last]).delete()
+        merged.add(row[pa.master])
+    for master_id in merged:
+        votes = [vote.rating or 0 for vote in db(pa.master==master_id).select(pa.rating)]
+        db(pm.id==master_id).update(rating_sum=sum(votes),counter=len(votes),
+                                    rating=votes and float(sum(votes))/len(votes) or 0)
+    for name, table, columns in [('plugin_rating_master_record','plugin_rating_master','tablename, record_id'),
+                                 ('plugin_rating_aux_user','plugin_rating_aux','master, created_by')]:
+        if db._uri.startswith('mysql'): # no CREATE INDEX IF NOT EXISTS
+            if db.executesql("SHOW INDEX FROM %s WHERE Key_name='%s';" % (table,name)):
+                continue
+            sql = 'CREATE UNIQUE INDEX %s ON %s (%s);' % (name,table,columns)
+        else:
+            sql = 'CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (%s);' % (name,table,columns)
+        try:
+            db.executesql(sql)
+        except Exception, e:
+            db.rollback()
+            raise RuntimeError, "plugin_rating cannot create its unique index %s: %s" % (name,e)
+    return True
+
+cache.ram('plugin_rating_upgrade',plugin_rating_upgrade,None)
+
+def plugin_rating_insert(insert):
+    """
+    calls insert() and returns its result, or None if a unique index rejects
+    the row because a concurrent request inserted it first; only that
+    conflict is caught. On PostgreSQL the insert runs in a savepoint so the
+    conflict does not abort the transaction (SQLite and MySQL only roll
+    back the failed statement). Each plugin keeps its own copy of this
+    helper so that it can be installed alone.
+    """
+    IntegrityError = getattr(db._adapter.driver,'IntegrityError',None) or Exception
+    savepoint = db._uri.startswith('postgres')
+    if savepoint:
+        db.executesql('SAVEPOINT plugin_rating_insert;')
+    try:
+        value = insert()
+    except IntegrityError:
+        if savepoint:
+            db.executesql('ROLLBACK TO SAVEPOINT plugin_rating_insert;')
+        return None
+    if savepoint:
+        db.executesql('RELEASE SAVEPOINT plugin_rating_insert;')
+    return value
+
+def plugin_rating_master_id(tablename,record_id):
+    """
+    returns the id of the master row of a record, creating it if needed.
+    If another request creates it first the unique index rejects our
+    insert and the winner's row is used.
+    """
+    pm = db.plugin_rating_master
+    query = (pm.tablename==tablename)&(pm.record_id==record_id)
+    row = db(query).select(pm.id).first()
+    if row:
+        return row.id
+    return plugin_rating_insert(lambda: pm.insert(tablename=tablename,record_id=record_id,
+                                                  rating=0,rating_sum=0,counter=0)) or \
+        db(query).select(pm.id).first().id
+
+def plugin_rating_vote(tablename,record_id,rating,user_id):
+    """
+    stores the rating of user_id for a record, replacing a previous one.
+    The master totals are changed with rating_sum=rating_sum+x and
+    counter=counter+1 expressions so concurrent votes are never lost. A
+    changed vote is only applied if the stored rating is still the one
+    read (otherwise a concurrent vote of the same user changed it and we
+    read again), so the sum moves by the difference exactly once.
+    """
+    pm, pa = db.plugin_rating_master, db.plugin_rating_aux
+    master_id = plugin_rating_master_id(tablename,record_id)
+    master = db(pm.id==master_id)
+    for attempt in range(5):
+        record = db(pa.master==master_id)(pa.created_by==user_id)\
+            .select(pa.id,pa.rating).first()
+        if not record:
+            if plugin_rating_insert(lambda: pa.insert(master=master_id,rating=rating,
+                                                      created_by=user_id)):
+                master.update(rating_sum=pm.rating_sum+rating,counter=pm.counter+1)
+                break
+        elif record.rating==rating:
+            return
+        elif db(pa.id==record.id)(pa.rating==record.rating).update(rating=rating):
+            master.update(rating_sum=pm.rating_sum+(rating-record.rating))
+            break
     else:
-        rating = row.rating
-    return TAG[''](DIV(_id='star1',_class='rating'),
-                   SCRIPT("jQuery(document).ready(function(){jQuery('#star1').rating('%s',{maxvalue:5,curvalue:%s});});" % (URL(r=request,c='plugin_rating',f='rate',args=[tablename,record_id]),rating)))
+        return
+    master.update(rating=pm.rating_sum/pm.counter)
+
+if not 'plugin_rating_buffered' in globals():
+    plugin_rating_buffered = False
+if not 'plugin_rating_flush_interval' in globals():
+    plugin_rating_flush_interval = 10
+
+def plugin_rating_folder():
+    import os
+    folder = os.path.join(request.folder,'private','plugin_rating')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    return folder
+
+def plugin_rating_enqueue(tablename,record_id,rating,user_id):
+    """
+    appends a vote to the journal (private/plugin_rating/votes.log)
+    instead of writing it to the database, see plugin_rating_flush.
+    Raises ValueError for values that would corrupt the journal.
+    """
+    import os
+    if not isinstance(tablename,str) or '\t' in tablename or '\n' in tablename or \
+            not 0<float(rating)<=5:
+        raise ValueError, "invalid vote"
+    record_id, user_id = int(record_id), user_id and int(user_id) or ''
+    from gluon import portalocker
+    folder = plugin_rating_folder()
+    lock = open(os.path.join(folder,'votes.lock'),'a')
+    portalocker.lock(lock,portalocker.LOCK_EX)
+    try:
+        journal = open(os.path.join(folder,'votes.log'),'a')
+        journal.write('%s\t%s\t%s\t%s\n' % (tablename,record_id,user_id,rating))
+        journal.close()
+    finally:
+        portalocker.unlock(lock)
+        lock.close()
+
+def plugin_rating_flush():
+    """
+    applies the journaled votes in one transaction and returns how many
+    coalesced votes were applied (None if another flush is running).
+
+    The journal is first renamed to votes.pending, which is only removed
+    after commit. A pending file left by a crash is applied again before
+    newer votes; this is harmless because a vote sets the user's rating
+    rather than adding to it, so the totals are changed exactly once.
+    Call it from cron or the scheduler, rate() also calls it at most
+    every plugin_rating_flush_interval seconds.
+    """
+    import os
+    from gluon import portalocker
+    pm, pa = db.plugin_rating_master, db.plugin_rating_aux
+    folder = plugin_rating_folder()
+    flushing = open(os.path.join(folder,'flush.lock'),'a')
+    try:
+        portalocker.lock(flushing,portalocker.LOCK_EX|portalocker.LOCK_NB)
+    except IOError:
+        flushing.close()
+        return None
+    try:
+        pending = os.path.join(folder,'votes.pending')
+        if not os.path.exists(pending):
+            lock = open(os.path.join(folder,'votes.lock'),'a')
+            portalocker.lock(lock,portalocker.LOCK_EX)
+            try:
+                if os.path.exists(os.path.join(folder,'votes.log')):
+                    os.rename(os.path.join(folder,'votes.log'),pending)
+            finally:
+                portalocker.unlock(lock)
+                lock.close()
+        if not os.path.exists(pending):
+            return 0
+        masters = {}
+        for line in open(pending,'r'):
+            items = line.rstrip('\n').split('\t')
+            if len(items)!=4:
+                continue # truncated by a crash while writing
+            tablename, record_id, user_id, rating = items
+            try:
+                record_id, user_id, rating = int(record_id), user_id and int(user_id) or None, float(rating)
+            except ValueError:
+                continue
+            if not tablename in db.tables or not 0<rating<=5:
+                continue
+            masters.setdefault((tablename,record_id),{})[user_id] = rating
+        n = 0
+        for (tablename, record_id), votes in masters.items():
+            master_id = plugin_rating_master_id(tablename,record_id)
+            users = [user_id for user_id in votes if user_id]
+            query = (pa.created_by==None)
+            if users:
+                query = query|pa.created_by.belongs(users)
+            old = dict((row.created_by,row) for row in db(pa.master==master_id)(query)\
+                           .select(pa.id,pa.created_by,pa.rating))
+            rating_sum, counter = 0, 0
+            for user_id, rating in votes.items():
+                if not user_id in old:
+                    pa.insert(master=master_id,rating=rating,created_by=user_id)
+                    rating_sum, counter = rating_sum+rating, counter+1
+                elif old[user_id].rating!=rating:
+                    db(pa.id==old[user_id].id).update(rating=rating)
+                    rating_sum += rating-old[user_id].rating
+            if rating_sum or counter:
+                master = db(pm.id==master_id)
+                master.update(rating_sum=pm.rating_sum+rating_sum,counter=pm.counter+counter)
+                master.update(rating=pm.rating_sum/pm.counter)
+            n += len(votes)
+        db.commit()
+        os.unlink(pending)
+        return n
+    finally:
+        portalocker.unlock(flushing)
+        flushing.close()
+
+def plugin_rating_widget(tablename,record_id,rating,user_rating=None):
+    """
+    the star widget of one record; the DOM id is unique per record.
+    If the user has rated the record the stars show the user's rating
+    and the widget has the extra class "rated".
+    """
+    _id = 'plugin_rating_%s_%s' % (tablename,record_id)
+    return TAG[''](DIV(_id=_id,_class='rating rated' if user_rating else 'rating'),
+                   SCRIPT("jQuery(document).ready(function(){jQuery('#%s').rating('%s',{maxvalue:5,curvalue:%s});});" % (_id,URL(r=request,c='plugin_rating',f='rate',args=[tablename,record_id]),user_rating or rating)))
+
+def plugin_rating_many(tablename,record_ids,user_ratings=False):
+    """
+    returns {record_id: widget} for all record_ids with one query::
+
+        widgets = plugin_rating_many('product',[row.id for row in rows])
+        {{for row in rows:}}{{=row.name}} {{=widgets[row.id]}}{{pass}}
+
+    if user_ratings is True the current user's own ratings are fetched
+    in the same query (left join on plugin_rating_aux) and shown.
+    """
+    pm, pa = db.plugin_rating_master, db.plugin_rating_aux
+    record_ids = [int(i) for i in record_ids]
+    query = (pm.tablename==tablename)&(pm.record_id.belongs(record_ids))
+    if user_ratings and auth.user_id:
+        rows = db(query).select(pm.record_id,pm.rating,pa.rating,
+                                left=pa.on((pa.master==pm.id)&(pa.created_by==auth.user_id)))
+        ratings = dict((row.plugin_rating_master.record_id,
+                        (row.plugin_rating_master.rating,row.plugin_rating_aux.rating)) \
+                           for row in rows)
+    else:
+        ratings = dict((row.record_id,(row.rating,None)) for row in \
+                           db(query).select(pm.record_id,pm.rating))
+    return dict((i,plugin_rating_widget(tablename,i,*ratings.get(i,(2,None)))) \
+                    for i in record_ids)
+
+def plugin_rating(tablename,record_id=0):
+    return plugin_rating_many(tablename,[record_id])[int(record_id)]
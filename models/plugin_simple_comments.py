@@ -9,5 +9,81 @@ db.define_table('plugin_simple_comments_comment',
                 Field('created_on','datetime',default=request.now,
                       readable=False,writable=False))
 
+db.define_table('plugin_simple_comments_counter',
+                Field('tablename'),
+                Field('record_id','integer'),
+                Field('counter','integer',default=0))
+
+def plugin_simple_comments_indexes():
+    """
+    creates the indexes used to list and count comments, once per process
+    """
+    if request.env.web2py_runtime_gae:
+        return
+    for sql in ['CREATE INDEX IF NOT EXISTS plugin_simple_comments_comment_record ON plugin_simple_comments_comment (tablename, record_id);',
+                'CREATE UNIQUE INDEX IF NOT EXISTS plugin_simple_comments_counter_record ON plugin_simple_comments_counter (tablename, record_id);']:
+        try:
+            db.executesql(sql)
+        except Exception:
+            db.rollback()
+    return True
+
+cache.ram('plugin_simple_comments_indexes',plugin_simple_comments_indexes,None)
+
+def plugin_simple_comments_insert(insert):
+    """
+    calls insert() and returns its result, or None if a unique index rejects
+    the row because a concurrent request inserted it first; only that
+    conflict is caught. On PostgreSQL the insert runs in a savepoint so the
+    conflict does not abort the transaction (SQLite and MySQL only roll
+    back the failed statement). Each plugin keeps its own copy of this
+    helper so that it can be installed alone.
+    """
+    IntegrityError = getattr(db._adapter.driver,'IntegrityError',None) or Exception
+    savepoint = db._uri.startswith('postgres')
+    if savepoint:
+        db.executesql('SAVEPOINT plugin_simple_comments_insert;')
+    try:
+        value = insert()
+    except IntegrityError:
+        if savepoint:
+            db.executesql('ROLLBACK TO SAVEPOINT plugin_simple_comments_insert;')
+        return None
+    if savepoint:
+        db.executesql('RELEASE SAVEPOINT plugin_simple_comments_insert;')
+    return value
+
+def plugin_simple_comments_counts(tablename,record_ids):
+    """
+    returns {record_id: number of comments} for all record_ids::
+
+        counts = plugin_simple_comments_counts('mytable',[row.id for row in rows])
+
+    counters are read from plugin_simple_comments_counter in one query;
+    records without a counter yet are counted with one GROUP BY and get one.
+    """
+    c, co = db.plugin_simple_comments_counter, db.plugin_simple_comments_comment
+    record_ids = set(int(i) for i in record_ids)
+    counts = dict((row.record_id,row.counter) for row in \
+                      db(c.tablename==tablename)(c.record_id.belongs(record_ids))\
+                      .select(c.record_id,c.counter))
+    missing = record_ids - set(counts)
+    if missing:
+        n = co.id.count()
+        for row in db(co.tablename==tablename)(co.record_id.belongs(missing))\
+                .select(co.record_id,n,groupby=co.record_id):
+            counts[row.plugin_simple_comments_comment.record_id] = row[n]
+        plugin_simple_comments_insert(lambda: c.bulk_insert(
+                [dict(tablename=tablename,record_id=i,counter=counts.get(i,0)) for i in missing]))
+        counts.update((i,counts.get(i,0)) for i in missing)
+    return counts
+
+def plugin_simple_comments_count(tablename,record_id,delta):
+    """
+    atomically adds delta to the comment counter of a record, if any
+    """
+    c = db.plugin_simple_comments_counter
+    db(c.tablename==tablename)(c.record_id==record_id).update(counter=c.counter+delta)
+
 def plugin_simple_comments(tablename=None,record_id=None):
     return LOAD('plugin_simple_comments','commenton',args=(tablename,record_id),ajax=True)
@@ -12,33 +12,179 @@ And create a callback controller:
 
 def sort():
     plugin_sortable_sort(db.test,sortable_field='sortable')
+
+After a drag the widget only sends the moved item and its new
+neighbours; positions are kept spaced by plugin_sortable_gap so that
+usually only the moved row is updated.
 """
 
 response.files.append(URL(r=request,c='static',f='plugin_sortable/jquery.ui.core.js'))
 response.files.append(URL(r=request,c='static',f='plugin_sortable/jquery.ui.sortable.js'))
 
+if not 'plugin_sortable_gap' in globals():
+    plugin_sortable_gap = 1024
+
 def plugin_sortable(items,callback,_id='sortable',_class='sortable'):
     script=SCRIPT("""
-function sortUpdate(a,b) {
-    var dragEls = jQuery(".%s_item");
-    var els ='';
-    jQuery.each(dragEls, function () {
-        var cur_id = jQuery(this).attr('id').split('_').shift();
-        els += cur_id+",";
-    });
-    var url = '%s?order='+els;
-    jQuery.get(url);
+function sortUpdate(event,ui) {
+    var id = function(el) { return el.length ? el.attr('id').split('_').shift() : ''; };
+    jQuery.get('%s',{moved:id(ui.item),
+                     prev:id(ui.item.prev('.%s_item')),
+                     next:id(ui.item.next('.%s_item'))});
 }
 jQuery(document).ready(function() {
   jQuery("#%s").sortable({stop:sortUpdate });
 });
-""" % (_id,callback,_id))
+""" % (callback,_id,_id,_id))
     return TAG[''](UL(_id=_id,_class=_class,
                       *[LI(item,_id="%s_%s"%(id,_id),_class='%s_item'%_id) for (id,item) in items]),
                    script)
 
+def plugin_sortable_reorder(table,ids,sortable_field='sortable',query=None):
+    """
+    stores the order of ids as positions 0, gap, 2*gap, ... with one
+    UPDATE ... SET sortable=CASE id WHEN ... END per 500 items
+    """
+    ids = [int(id) for id in ids]
+    if request.env.web2py_runtime_gae:
+        for i,id in enumerate(ids):
+            table._db(table.id==id)(query or table.id>0)\
+                .update(**{sortable_field:i*plugin_sortable_gap})
+        return
+    for k in range(0,len(ids),500):
+        chunk = ids[k:k+500]
+        where = table.id.belongs(chunk)
+        if query: where = where&query
+        table._db.executesql('UPDATE %s SET %s=CASE %s.%s %s END WHERE %s;' % \
+            (table._tablename,sortable_field,table._tablename,table._id.name,
+             ' '.join(['WHEN %i THEN %i' % (id,(k+i)*plugin_sortable_gap) \
+                           for i,id in enumerate(chunk)]),
+             where))
+
+def plugin_sortable_move(table,moved,prev=None,next=None,sortable_field='sortable',query=None):
+    """
+    moves item moved between items prev and next. Either may be None:
+    the other neighbour is then looked up, so moved goes right after prev
+    or right before next (or to an end of the list). Only the moved row
+    is updated when there is room between the neighbours' positions,
+    otherwise the list is renumbered.
+    """
+    field = table[sortable_field]
+    dbset = table._db(query or table.id>0)
+    moved, prev, next = int(moved), int(prev or 0), int(next or 0)
+    positions = dict((row.id,row[sortable_field]) for row in \
+                         dbset(table.id.belongs([moved,prev,next])).select(table.id,field))
+    if not moved in positions or (prev and not prev in positions) \
+            or (next and not next in positions):
+        return
+    low, high = positions.get(prev), positions.get(next)
+    others = dbset(~table.id.belongs([moved,prev,next]))
+    if prev and low is not None and not next:
+        row = others(field>=low).select(table.id,field,orderby=field|table.id,
+                                        limitby=(0,1)).first()
+        if row: next, high = row.id, row[sortable_field]
+    elif next and high is not None and not prev:
+        row = others(field<=high).select(table.id,field,orderby=~field|~table.id,
+                                         limitby=(0,1)).first()
+        if row: prev, low = row.id, row[sortable_field]
+    position = None
+    if prev and low is None or next and high is None:
+        pass
+    elif not prev and not next:
+        return
+    elif not prev:
+        position = high-plugin_sortable_gap
+    elif not next:
+        position = low+plugin_sortable_gap
+    elif high-low>1:
+        position = (low+high)//2
+    if position is not None:
+        dbset(table.id==moved).update(**{sortable_field:position})
+        return
+    ids = [row.id for row in dbset.select(table.id,orderby=field|table.id) if row.id!=moved]
+    ids.insert(ids.index(prev)+1 if prev else 0,moved)
+    plugin_sortable_reorder(table,ids,sortable_field,query)
 
 def plugin_sortable_sort(table,sortable_field='sortable',query=None):
-    for i,id in enumerate(request.vars.order.split(',')[:-1]):
-        if not query: db(table.id==id).update(**{sortable_field:i})
-        else: db(table.id==id)(query).update(**{sortable_field:i})
+    try:
+        if request.vars.moved:
+            plugin_sortable_move(table,request.vars.moved,request.vars.prev,
+                                 request.vars.next,sortable_field,query)
+        elif request.vars.order:
+            plugin_sortable_reorder(table,[id for id in request.vars.order.split(',') if id],
+                                    sortable_field,query)
+    except ValueError:
+        raise HTTP(400)
+
+def plugin_sortable_window(source,callback,_id='sortable',_class='sortable'):
+    """
+    like plugin_sortable but for long lists: the items are fetched one page
+    at a time from source, an action returning plugin_sortable_page(...).
+    The last item of the previous page and the first of the next one are
+    shown (dimmed) at the edges so items can be moved across pages.
+    """
+    script=SCRIPT("""
+jQuery(document).ready(function() {
+  var ul = jQuery("#%(id)s"), page = 0;
+  var id = function(el) { return el.length ? el.attr('id').split('_').shift() : ''; };
+  function item(data,boundary) {
+    var li = jQuery('<li/>').attr('id',data[0]+'_%(id)s').addClass('%(id)s_item').text(data[1]);
+    return boundary ? li.css('opacity',0.5) : li;
+  }
+  function load(p) {
+    jQuery.getJSON('%(source)s',{page:p},function(data) {
+      page = data.page;
+      ul.empty();
+      if(data.before) ul.append(item(data.before,true));
+      jQuery.each(data.items,function(i,data){ ul.append(item(data,false)); });
+      if(data.after) ul.append(item(data.after,true));
+      jQuery("#%(id)s_page").text((data.page+1)+'/'+data.pages);
+    });
+  }
+  ul.sortable({stop:function(event,ui) {
+    jQuery.get('%(callback)s',{moved:id(ui.item),prev:id(ui.item.prev()),next:id(ui.item.next())},
+               function(){ load(page); });
+  }});
+  jQuery("#%(id)s_prev").click(function(){ if(page>0) load(page-1); return false; });
+  jQuery("#%(id)s_next").click(function(){ load(page+1); return false; });
+  load(0);
+});
+""" % dict(id=_id,source=source,callback=callback))
+    return TAG[''](UL(_id=_id,_class=_class),
+                   DIV(A('<',_href='#',_id=_id+'_prev'),' ',
+                       SPAN(_id=_id+'_page'),' ',
+                       A('>',_href='#',_id=_id+'_next')),
+                   script)
+
+def plugin_sortable_page(table,represent='name',sortable_field='sortable',
+                         query=None,items_per_page=50):
+    """
+    serves request.vars.page of the ordered list as json for
+    plugin_sortable_window; represent is a field name or a function of
+    the row. In a controller:
+
+    def fruits():
+        return plugin_sortable_page(db.fruit,'name',query=my_fruits)
+
+    Only the requested page plus one item on each side is selected.
+    """
+    from gluon.serializers import json
+    field = table[sortable_field]
+    dbset = table._db(query or table.id>0)
+    try:
+        page = max(int(request.vars.page or 0),0)
+    except ValueError:
+        raise HTTP(400)
+    pages = max((dbset.count()+items_per_page-1)//items_per_page,1)
+    page = min(page,pages-1)
+    start = page*items_per_page
+    if isinstance(represent,str):
+        fields, label = [table.id,table[represent]], lambda row: row[represent]
+    else:
+        fields, label = [table.ALL], represent
+    rows = dbset.select(orderby=field|table.id,
+                        limitby=(max(start-1,0),start+items_per_page+1),*fields)
+    items = [[row.id,'%s' % label(row)] for row in rows]
+    before = start and items and items.pop(0) or None
+    after = len(items)>items_per_page and items.pop() or None
+    return json(dict(page=page,pages=pages,items=items,before=before,after=after))
@@ -23,6 +23,257 @@ db.define_table('plugin_tagging_subscription',
 db.plugin_tagging_tag.name.requires = IS_NOT_EMPTY()
 db.plugin_tagging_link.tag.requires = IS_IN_DB(db,'plugin_tagging_tag.id','%(name)s')
 
+if not 'plugin_tagging_cache' in globals():
+    plugin_tagging_cache = cache.ram
+if not 'plugin_tagging_index_ttl' in globals():
+    plugin_tagging_index_ttl = 600
+
+def plugin_tagging_indexes():
+    """
+    creates the indexes used by the tagging queries, once per process.
+    Tags of the same name created by older versions are merged first into
+    the oldest one (links, subscriptions and counter). If the unique index
+    on names still cannot be created this raises, because without it
+    concurrent requests create duplicate tags.
+    """
+    if request.env.web2py_runtime_gae:
+        return
+    db_tag, db_link = db.plugin_tagging_tag, db.plugin_tagging_link
+    first, n = db_tag.id.min(), db_tag.id.count()
+    for row in db(db_tag.id>0).select(db_tag.name,first,groupby=db_tag.name,having=n>1):
+        others = db(db_tag.name==row[db_tag.name])(db_tag.id!=row[first])
+        ids = [tag.id for tag in others.select(db_tag.id)]
+        db(db_link.tag.belongs(ids)).update(tag=row[first])
+        db(db.plugin_tagging_subscription.tag.belongs(ids)).update(tag=row[first])
+        others.delete()
+        db(db_tag.id==row[first]).update(links=db(db_link.tag==row[first]).count())
+    for sql in ['CREATE INDEX IF NOT EXISTS plugin_tagging_tag_links ON plugin_tagging_tag (links);',
+                'CREATE INDEX IF NOT EXISTS plugin_tagging_link_record ON plugin_tagging_link (table_name, record_id);',
+                'CREATE INDEX IF NOT EXISTS plugin_tagging_link_tag ON plugin_tagging_link (tag, table_name, record_id);']:
+        try:
+            db.executesql(sql)
+        except Exception:
+            db.rollback()
+    if db._uri.startswith('mysql'): # no CREATE INDEX IF NOT EXISTS
+        if db.executesql("SHOW INDEX FROM plugin_tagging_tag WHERE Key_name='plugin_tagging_tag_name';"):
+            return True
+        # 191 characters fit the 767 byte key limit of utf8mb4
+        sql = 'CREATE UNIQUE INDEX plugin_tagging_tag_name ON plugin_tagging_tag (name(191));'
+    else:
+        sql = 'CREATE UNIQUE INDEX IF NOT EXISTS plugin_tagging_tag_name ON plugin_tagging_tag (name);'
+    try:
+        db.executesql(sql)
+    except Exception, e:
+        db.rollback()
+        raise RuntimeError, "plugin_tagging cannot create its unique index on tag names: %s" % e
+    return True
+
+cache.ram('plugin_tagging_indexes',plugin_tagging_indexes,None)
+
+def plugin_tagging_insert(insert):
+    """
+    calls insert() and returns its result, or None if a unique index rejects
+    the row because a concurrent request inserted it first; only that
+    conflict is caught. On PostgreSQL the insert runs in a savepoint so the
+    conflict does not abort the transaction (SQLite and MySQL only roll
+    back the failed statement). Each plugin keeps its own copy of this
+    helper so that it can be installed alone.
+    """
+    IntegrityError = getattr(db._adapter.driver,'IntegrityError',None) or Exception
+    savepoint = db._uri.startswith('postgres')
+    if savepoint:
+        db.executesql('SAVEPOINT plugin_tagging_insert;')
+    try:
+        value = insert()
+    except IntegrityError:
+        if savepoint:
+            db.executesql('ROLLBACK TO SAVEPOINT plugin_tagging_insert;')
+        return None
+    if savepoint:
+        db.executesql('RELEASE SAVEPOINT plugin_tagging_insert;')
+    return value
+
+plugin_tagging_lib = local_import('plugin_tagging')
+
+# tag id -> bitmap of the tagged records of each searched table, shared by
+# the requests of this process; a table is loaded again after
+# plugin_tagging_index_ttl seconds to forget links removed by other processes
+plugin_tagging_index = cache.ram('plugin_tagging_index',
+                                 lambda: plugin_tagging_lib.Index(plugin_tagging_index_ttl),
+                                 None)
+
+def plugin_tagging_normalize(name):
+    """
+    ' Python  web' -> 'Python web/'
+    """
+    import re
+    name = re.sub('\s+',' ',name).strip()
+    if not name[-1:]=='/': name+='/'
+    return name
+
+def plugin_tagging_add(table_name,record_ids,names):
+    """
+    tags every record in record_ids with every tag in names (a list or a
+    comma separated string)::
+
+        plugin_tagging_add('mytable',[1,2,3],'python,web2py')
+
+    missing tags are created with one guarded INSERT each (the ones another
+    request creates at the same time are read back), existing links are
+    found with one SELECT and left alone, new links are written by
+    plugin_tagging_insert_links and the links counter of each tag is
+    incremented in one UPDATE per distinct increment. Returns the number
+    of links created.
+    """
+    db_tag, db_link = db.plugin_tagging_tag, db.plugin_tagging_link
+    if not isinstance(record_ids,(list,tuple,set)):
+        record_ids = [record_ids]
+    record_ids = set(int(i or 0) for i in record_ids)
+    if isinstance(names,basestring):
+        names = names.split(',')
+    names = set(plugin_tagging_normalize(name) for name in names) - set(['/'])
+    if not names or not record_ids:
+        return 0
+    tags = dict((tag.name,tag.id) for tag in \
+                    db(db_tag.name.belongs(names)).select(db_tag.id,db_tag.name))
+    missing = [name for name in names if not name in tags]
+    if missing:
+        for name in missing:
+            plugin_tagging_insert(lambda: db_tag.insert(name=name,links=0))
+        tags.update((tag.name,tag.id) for tag in \
+                        db(db_tag.name.belongs(missing)).select(db_tag.id,db_tag.name))
+    tag_ids = tags.values()
+    existing = set((link.tag,link.record_id) for link in \
+                       db(db_link.tag.belongs(tag_ids))\
+                       (db_link.table_name==table_name)\
+                       (db_link.record_id.belongs(record_ids))\
+                       .select(db_link.tag,db_link.record_id))
+    new_links = [dict(tag=tag_id,table_name=table_name,record_id=record_id) \
+                     for tag_id in tag_ids for record_id in record_ids \
+                     if not (tag_id,record_id) in existing]
+    if not new_links:
+        return 0
+    plugin_tagging_insert_links(new_links)
+    plugin_tagging_count(new_links,+1)
+    return len(new_links)
+
+def plugin_tagging_insert_links(links,chunk=500):
+    """
+    inserts links (dicts of tag, table_name, record_id) with multi-row
+    INSERT statements of up to chunk rows on SQLite, PostgreSQL and MySQL;
+    other backends use bulk_insert, which is one INSERT per row on SQL
+    adapters and a batch put on GAE
+    """
+    db_link = db.plugin_tagging_link
+    if not db._uri.split(':')[0] in ('sqlite','postgres','mysql'):
+        db_link.bulk_insert(links)
+        return
+    represent = db._adapter.represent
+    for i in range(0,len(links),chunk):
+        values = ','.join(['(%s,%s,%s)' % (represent(link['tag'],'integer'),
+                                           represent(link['table_name'],'string'),
+                                           represent(link['record_id'],'integer')) \
+                               for link in links[i:i+chunk]])
+        db.executesql('INSERT INTO plugin_tagging_link (tag, table_name, record_id) VALUES %s;' % values)
+
+def plugin_tagging_remove(table_name,record_id,link_ids):
+    """
+    removes the links in link_ids that belong to (table_name, record_id)
+    and decrements the links counter of the corresponding tags.
+    Returns the number of links removed.
+    """
+    db_link = db.plugin_tagging_link
+    links = db(db_link.id.belongs([int(i) for i in link_ids]))\
+        (db_link.table_name==table_name)\
+        (db_link.record_id==int(record_id or 0))
+    rows = links.select(db_link.id,db_link.tag,db_link.record_id)
+    if not rows:
+        return 0
+    links.delete()
+    plugin_tagging_count([dict(tag=row.tag,table_name=table_name,record_id=row.record_id) \
+                              for row in rows],-1)
+    return len(rows)
+
+def plugin_tagging_count(links,sign):
+    """
+    adds sign to plugin_tagging_tag.links for the tag of each link (a dict
+    of tag, table_name, record_id) with one atomic UPDATE per distinct
+    increment, and adds or removes the links in plugin_tagging_index
+    """
+    db_tag = db.plugin_tagging_tag
+    deltas = {}
+    for link in links:
+        deltas[link['tag']] = deltas.get(link['tag'],0)+1
+    groups = {}
+    for tag_id, delta in deltas.items():
+        groups.setdefault(delta,[]).append(tag_id)
+    for delta, tag_ids in groups.items():
+        db(db_tag.id.belongs(tag_ids)).update(links=db_tag.links+sign*delta)
+    tables = {}
+    for link in links:
+        tables.setdefault(link['table_name'],[]).append((link['tag'],link['record_id']))
+    for table_name, pairs in tables.items():
+        plugin_tagging_index.update(table_name,pairs,sign)
+    plugin_tagging_cache.clear(regex='^plugin_tagging_cloud_')
+
+def plugin_tagging_index_sync(table_name):
+    """
+    loads the links of table_name into plugin_tagging_index with two
+    queries if it is not loaded (or expired), otherwise reads the links
+    inserted since by any process, by id, with one query on the primary key
+    """
+    db_link = db.plugin_tagging_link
+    last = plugin_tagging_index.last(table_name)
+    if last is None:
+        last = db.executesql(db(db_link.id>0)._select(db_link.id.max()))[0][0] or 0
+        plugin_tagging_index.load(table_name,db.executesql(
+                db(db_link.table_name==table_name)._select(db_link.tag,db_link.record_id)),last)
+        return
+    rows = db.executesql(db(db_link.id>last)._select(db_link.id,db_link.table_name,
+                                                     db_link.tag,db_link.record_id))
+    if rows:
+        plugin_tagging_index.update(table_name,[(row[2],row[3]) for row in rows if row[1]==table_name],
+                                    +1,max([row[0] for row in rows]))
+
+def plugin_tagging_search(table_name,tags,mode='all',page=0,items_per_page=20,facets=True):
+    """
+    finds the records of table_name tagged with tags (a list or a comma
+    separated string)::
+
+        plugin_tagging_search('article',tags=['python/','web/'],mode='any')
+
+    mode='all' matches records having every tag, mode='any' records
+    having at least one. The matches are intersected or merged in
+    plugin_tagging_index, which plugin_tagging_add and plugin_tagging_remove
+    keep up to date, so a search costs two indexed queries (the tag ids and
+    the links inserted since the last search) whatever the number of links.
+    The facets of a search are computed once, which reads the records of
+    every tag of the table, and then kept exact as links change. Returns a
+    dict with the number of matching records (count), the record ids of
+    the requested page ordered by id (ids) and [(tag name, count), ...]
+    over all the matching records (facets, empty if facets=False).
+    """
+    if not mode in ('all','any'):
+        raise SyntaxError, "plugin_tagging_search mode must be 'all' or 'any'"
+    db_tag = db.plugin_tagging_tag
+    if isinstance(tags,basestring):
+        tags = tags.split(',')
+    names = set(plugin_tagging_normalize(name) for name in tags) - set(['/'])
+    page = max(int(page),0)
+    tag_ids = names and [tag.id for tag in db(db_tag.name.belongs(names)).select(db_tag.id)]
+    if not tag_ids or (mode=='all' and len(tag_ids)<len(names)):
+        return dict(count=0,facets=[],ids=[])
+    plugin_tagging_index_sync(table_name)
+    count, ids, counts = plugin_tagging_index.search(table_name,tag_ids,mode,page*items_per_page,
+                                                     (page+1)*items_per_page,facets)
+    names = plugin_tagging_index.names
+    missing = [tag_id for tag_id in counts if not tag_id in names]
+    if missing:
+        names.update((tag.id,tag.name) for tag in \
+                         db(db_tag.id.belongs(missing)).select(db_tag.id,db_tag.name))
+    facets = sorted([(names[tag_id],n) for tag_id, n in counts.items() if tag_id in names],
+                    key=lambda facet: (-facet[1],facet[0]))
+    return dict(count=count,facets=facets,ids=ids)
 
 def plugin_tagging(table_name=None,record_id=0):
     """
@@ -35,5 +286,32 @@ def plugin_tagging(table_name=None,record_id=0):
     """
     return LOAD('plugin_tagging',args=(table_name,record_id),ajax=True)
 
-def plugin_tagging_cloud():
-    return LOAD('plugin_tagging','tag_cloud')
+def plugin_tagging_cloud(limit=50,min_links=1):
+    """
+    embeds a cloud of the limit most linked tags having at least
+    min_links links
+    """
+    return LOAD('plugin_tagging','tag_cloud',
+                vars=dict(limit=limit,min_links=min_links))
+
+def plugin_tagging_cloud_data(limit=50,min_links=1):
+    """
+    returns [(name, font size in em), ...] sorted by name for the limit
+    (at most 1000) most linked tags having at least min_links links.
+    Sizes are bucketed in steps of 0.1em between 0.8em and 1.8em. One
+    snapshot of the 1000 most linked tags is kept in plugin_tagging_cache,
+    whatever the arguments, and dropped whenever a link is added or removed.
+    """
+    limit = min(max(int(limit),1),1000)
+    min_links = max(int(min_links),1)
+    def snapshot():
+        db_tag = db.plugin_tagging_tag
+        return [(tag.name,tag.links) for tag in db(db_tag.links>=1)\
+                    .select(db_tag.name,db_tag.links,orderby=~db_tag.links,limitby=(0,1000))]
+    tags = [(name,links) for name, links in \
+                plugin_tagging_cache('plugin_tagging_cloud_top',snapshot,3600) \
+                if links>=min_links][:limit]
+    if not tags:
+        return []
+    mc = tags[0][1]
+    return sorted((name,0.8+round(10.0*links/mc)/10) for name, links in tags)
@@ -18,15 +18,75 @@ db.define_table('plugin_wiki_page',
 db.define_table('plugin_wiki_page_archive',
                 Field('current_record',db.plugin_wiki_page),
                 db.plugin_wiki_page,
+                Field('delta','text',writable=False,readable=False),
                 format = '%(slug) %(modified_on)s')
 
+db.define_table('plugin_wiki_term',
+                Field('term'),
+                Field('page',db.plugin_wiki_page),
+                Field('hits','integer'))
+
 if not 'plugin_wiki_editor' in globals():
     plugin_wiki_editor = auth.user_id
 
 
+if not 'plugin_wiki_snapshot_every' in globals():
+    plugin_wiki_snapshot_every = 10
+if not 'plugin_wiki_lru_size' in globals():
+    plugin_wiki_lru_size = 1000
+if not 'plugin_wiki_lru_ttl' in globals():
+    plugin_wiki_lru_ttl = 60
+if not 'plugin_wiki_html_ttl' in globals():
+    plugin_wiki_html_ttl = 3600
+if not 'plugin_wiki_search_ranked' in globals():
+    # the matches ranked by hits, in page id order; deeper ones follow unranked
+    plugin_wiki_search_ranked = 1000
+
+plugin_wiki_lib = local_import('plugin_wiki')
+
+def plugin_wiki_setup():
+    """
+    creates the unique index on slug and returns True if the SQLite FTS4
+    table plugin_wiki_fts is available, in which case it is used as the
+    search index; otherwise the posting lists in plugin_wiki_term are used
+    and indexed. Runs once per process.
+    """
+    if request.env.web2py_runtime_gae:
+        return False
+    try:
+        db.executesql('CREATE UNIQUE INDEX IF NOT EXISTS plugin_wiki_page_slug ON plugin_wiki_page (slug);')
+    except Exception:
+        db.rollback()
+    if db._uri.startswith('sqlite'):
+        try:
+            db.executesql('CREATE VIRTUAL TABLE IF NOT EXISTS plugin_wiki_fts USING fts4(title, body);')
+            return True
+        except Exception:
+            pass
+    for sql in ['CREATE INDEX IF NOT EXISTS plugin_wiki_term_term ON plugin_wiki_term (term, page);',
+                'CREATE INDEX IF NOT EXISTS plugin_wiki_term_page ON plugin_wiki_term (page);']:
+        try:
+            db.executesql(sql)
+        except Exception:
+            db.rollback()
+    return False
+
+plugin_wiki_fts = cache.ram('plugin_wiki_setup',plugin_wiki_setup,None)
+
+# slug -> page metadata and rendered html, shared by the requests of this
+# process; entries expire after plugin_wiki_lru_ttl seconds so that pages
+# saved through other processes are picked up
+plugin_wiki_pages = cache.ram('plugin_wiki_pages',
+                              lambda: plugin_wiki_lib.LRU(plugin_wiki_lru_size,plugin_wiki_lru_ttl),
+                              None)
+
+# page id -> (modified_on, rendered html), bounded like plugin_wiki_pages
+# but kept longer since entries are checked against modified_on
+plugin_wiki_htmls = cache.ram('plugin_wiki_htmls',
+                              lambda: plugin_wiki_lib.LRU(plugin_wiki_lru_size,plugin_wiki_html_ttl),
+                              None)
+
 def plugin_wiki_render(text):
-    import re
-    from gluon.contrib.markdown import WIKI
     """
     [link](page:test.abc) -> <a href=".../plugin_wiki/page/this-is-a-slug">link</a>
     [link](attachment:123.abc) -> <a href=".../attachment/123.abc">link</a>
@@ -35,22 +95,217 @@ def plugin_wiki_render(text):
     ![flv file](attachment:test.flv) -> flash player
     ![mp4 file](attachment:test.mp4) -> flash player
     """
+    return XML(plugin_wiki_lib.render(text,
+                                      URL(r=request,c='plugin_wiki',f='page'),
+                                      URL(r=request,c='plugin_attachments',f='attachment'),
+                                      URL(r=request,c='static',f='plugin_mediaplayer/mediaplayer.swf')))
+
+def plugin_wiki_html(page):
+    """
+    the rendered body of a page, cached in plugin_wiki_htmls by (page id,
+    modified_on) so that page views do not run markdown again until the
+    page is saved (or the entry expires or is dropped to make room)
+    """
+    value = plugin_wiki_htmls.get(page.id)
+    if value is None or value[0]!=page.modified_on:
+        value = (page.modified_on,plugin_wiki_render(page.body).xml())
+        plugin_wiki_htmls.set(page.id,value)
+    return XML(value[1])
+
+def plugin_wiki_lookup(slug):
+    """
+    the page with this slug as a Storage of id, slug, title, active, public,
+    created_by, modified_on and html (the rendered body), or None. Warm
+    lookups do not touch the database.
+    """
+    from gluon.storage import Storage
+    page = plugin_wiki_pages.get(slug)
+    if page is None:
+        w = db.plugin_wiki_page
+        row = db(w.slug==slug).select(w.id,w.slug,w.title,w.active,w.public,w.created_by,
+                                      w.modified_on,w.body,limitby=(0,1)).first()
+        if not row:
+            return None
+        page = Storage(id=row.id,slug=row.slug,title=row.title,active=row.active,
+                       public=row.public,created_by=row.created_by,
+                       modified_on=row.modified_on,html=plugin_wiki_html(row).xml())
+        plugin_wiki_pages.set(slug,page)
+    return page
+
+def plugin_wiki_forget(form):
+    """
+    onaccept callback that drops the saved page from plugin_wiki_pages
+    and the ids of the hidden pages
+    """
+    if form.record:
+        plugin_wiki_pages.pop(form.record.slug)
+    cache.ram('plugin_wiki_hidden',None)
+
+def plugin_wiki_hidden():
+    """
+    the ids of the pages anonymous users cannot read (not public or not
+    active), cached for plugin_wiki_lru_ttl seconds like the pages
+    """
+    w = db.plugin_wiki_page
+    hidden = (w.public==None)|(w.active==None)|~((w.public==True)&(w.active==True))
+    return cache.ram('plugin_wiki_hidden',
+                     lambda: [row[0] for row in db.executesql(db(hidden)._select(w.id))],
+                     plugin_wiki_lru_ttl)
 
-    text=text or ''
-    re_flv=re.compile('\<img\s+src="(?P<src>[^"]+\.(flv|wav|mp3|mpeg3|mp4|mpeg4|mov))"\s+alt="(?P<alt>[^"]*)"\s*/\>')
-    re_youtube=re.compile('\<img\s+src="http://www.youtube.com/watch\?v=(?P<code>\w+)"\s+alt="(?P<alt>[^"]*)"\s*/\>')
-    re_vimeo=re.compile('\<img\s+src="http://vimeo.com/(?P<code>\w+)"\s+alt="(?P<alt>[^"]*)"\s*/\>')
-    text=text.replace('!(','![no name](')
-    text=text.replace('](page:','](%s/' % URL(r=request,c='plugin_wiki',f='page'))
-    text=text.replace('](attachment:','](%s/' % URL(r=request,c='plugin_attachments',f='attachment'))
-    re_code = re.compile('<code>(?P<code>.*?)</code>',re.S)
+def plugin_wiki_not_modified(page):
+    """
+    sets ETag and Last-Modified from page.modified_on and the current user
+    and raises HTTP 304 if the client already has this version of the page
+    """
+    import time
+    stamp = time.mktime(page.modified_on.timetuple())
+    etag = '"%s-%i-%s"' % (page.id,stamp,auth.user_id or 0)
+    last_modified = time.strftime('%a, %d %b %Y %H:%M:%S GMT',time.gmtime(stamp))
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = last_modified
+    response.headers['Cache-Control'] = 'private, max-age=0, must-revalidate'
+    if request.env.http_if_none_match:
+        fresh = etag in [tag.strip() for tag in request.env.http_if_none_match.split(',')]
+    else:
+        fresh = request.env.http_if_modified_since==last_modified
+    if fresh:
+        raise HTTP(304,**response.headers)
+
+def plugin_wiki_archive(form):
+    """
+    onaccept callback used instead of crud.archive. The previous version
+    of the page is archived as a full body every plugin_wiki_snapshot_every
+    revisions and as a delta from the previous archived revision otherwise
+    (body is then None).
+    """
+    page = form.record
+    if not page:
+        return
+    h = db.plugin_wiki_page_archive
+    recent = db(h.current_record==page.id).select(h.id,h.delta,orderby=~h.id,
+                                                  limitby=(0,plugin_wiki_snapshot_every))
+    deltas = 0
+    for row in recent:
+        if row.delta is None: break
+        deltas += 1
+    record = dict((f,page[f]) for f in h.fields \
+                      if f in page and not f in ('id','current_record','delta'))
+    record['current_record'] = page.id
+    if recent and deltas+1<plugin_wiki_snapshot_every:
+        record['delta'] = plugin_wiki_lib.diff(plugin_wiki_revision(recent[0].id),page.body)
+        record['body'] = None
+    h.insert(**record)
+
+def plugin_wiki_revision(archive_id):
+    """
+    the body of an archived revision, rebuilt from the closest preceding
+    snapshot by applying the deltas stored after it
+    """
+    h = db.plugin_wiki_page_archive
+    row = db(h.id==archive_id).select(h.id,h.current_record).first()
+    if not row:
+        return None
+    revisions = db(h.current_record==row.current_record)(h.id<=row.id)
+    snapshot = revisions(h.delta==None).select(h.id,h.body,orderby=~h.id,limitby=(0,1)).first()
+    body = snapshot and snapshot.body or ''
+    for delta in revisions(h.id>(snapshot and snapshot.id or 0)).select(h.delta,orderby=h.id):
+        body = plugin_wiki_lib.patch(body,delta.delta)
+    return body
+
+def plugin_wiki_index(page_id,title,body):
+    """
+    replaces the search index entries of one page
+    """
+    if plugin_wiki_fts:
+        db.executesql('DELETE FROM plugin_wiki_fts WHERE docid=?;',(page_id,))
+        db.executesql('INSERT INTO plugin_wiki_fts (docid, title, body) VALUES (?,?,?);',
+                      (page_id,title or '',body or ''))
+    else:
+        t = db.plugin_wiki_term
+        db(t.page==page_id).delete()
+        t.bulk_insert([dict(term=term,page=page_id,hits=hits) for term, hits in \
+                           plugin_wiki_lib.terms('%s %s' % (title or '',body or '')).items()])
+
+def plugin_wiki_index_form(form):
+    """
+    onaccept callback that indexes the page just saved
+    """
+    plugin_wiki_index(form.vars.id,form.vars.title,form.vars.body)
+
+def plugin_wiki_reindex():
+    """
+    rebuilds the search index of all the pages, for example from a shell:
+
+        python web2py.py -S <app> -M
+        >>> plugin_wiki_reindex(); db.commit()
+    """
+    w = db.plugin_wiki_page
+    if plugin_wiki_fts:
+        db.executesql('DELETE FROM plugin_wiki_fts;')
+    else:
+        db(db.plugin_wiki_term.id>0).delete()
+    n = last = 0
     while True:
-        match = re_code.search(text)
-        if not match: break
-        code='\n\n    %s\n\n' % '\n    '.join([line for line in match.group('code').split('\n')])
-        text=text[:match.start()]+code+text[match.end():]
-    html = WIKI(text).xml()
-    html = re_flv.sub('<embed allowfullscreen="true" allowscriptaccess="always" flashvars="height=305&width=490&file=\g<src>" height="305px" src="%s" width="490px"></embed>' % URL(r=request,c='static',f='plugin_mediaplayer/mediaplayer.swf'),html)
-    html = re_youtube.sub("""<object width="480" height="385"><param name="movie" value="http://www.youtube.com/v/\g<code>&hl=en_US&fs=1&"></param><param name="allowFullScreen" value="true"></param><param name="allowscriptaccess" value="always"></param><embed src="http://www.youtube.com/v/\g<code>&hl=en_US&fs=1&" type="application/x-shockwave-flash" allowscriptaccess="always" allowfullscreen="true" width="480" height="385"></embed></object>""",html)
-    html = re_vimeo.sub("""<object width="400" height="250"><param name="allowfullscreen" value="true" /><param name="allowscriptaccess" value="always" /><param name="movie" value="http://vimeo.com/moogaloop.swf?clip_id=\g<code>&amp;server=vimeo.com&amp;show_title=1&amp;show_byline=1&amp;show_portrait=0&amp;color=&amp;fullscreen=1" /><embed src="http://vimeo.com/moogaloop.swf?clip_id=\g<code>&amp;server=vimeo.com&amp;show_title=1&amp;show_byline=1&amp;show_portrait=0&amp;color=&amp;fullscreen=1" type="application/x-shockwave-flash" allowfullscreen="true" allowscriptaccess="always" width="400" height="250"></embed></object><p><a href="http://vimeo.com/\g<code>">web2py production deployment on vps.net</a> from <a href="http://vimeo.com/user315328">mdipierro</a> on <a href="http://vimeo.com">Vimeo</a>.</p>""",html)
-    return XML(html)
+        pages = db(w.id>last).select(w.id,w.title,w.body,orderby=w.id,limitby=(0,500))
+        if not pages:
+            return n
+        for page in pages:
+            plugin_wiki_index(page.id,page.title,page.body)
+        n, last = n+len(pages), pages[-1].id
+
+def plugin_wiki_search(query,page=0,items_per_page=10):
+    """
+    returns (number of matches, [(page, html snippet), ...]) for the pages
+    the current user can read that contain every word of query, best
+    matches first. FTS4 ranks the first plugin_wiki_search_ranked matches
+    by number of hits (matchinfo) and returns the others after them in page
+    id order, so common words cost one bounded query and a count. The
+    posting lists rank by tf-idf. Pages hidden from anonymous users are
+    filtered out in SQL.
+    """
+    import math, array
+    w = db.plugin_wiki_page
+    words = plugin_wiki_lib.terms(query).keys()
+    if not words:
+        return 0, []
+    start, stop = page*items_per_page, (page+1)*items_per_page
+    if plugin_wiki_fts:
+        match, hidden = ' '.join(words), not auth.user_id and plugin_wiki_hidden()
+        where = 'plugin_wiki_fts MATCH ?'+(hidden and ' AND docid NOT IN (%s)' % ','.join(map(str,hidden)) or '')
+        # 'y' (hits per phrase and column) needs SQLite 3.8.11, 'x' has them every third value
+        y = db._adapter.driver.sqlite_version_info>=(3,8,11)
+        rows = db.executesql('SELECT docid, matchinfo(plugin_wiki_fts,%s) FROM plugin_wiki_fts WHERE %s '
+                             'ORDER BY docid LIMIT %i;' % (y and "'y'" or "'x'",where,plugin_wiki_search_ranked),
+                             (match,))
+        hits = [(-sum(y and info or info[0::3]),docid) for docid, info in \
+                    [(row[0],array.array('I',str(row[1]))) for row in rows]]
+        ids_page = [docid for score, docid in sorted(hits)[start:stop]]
+        if len(rows)<plugin_wiki_search_ranked:
+            count = len(rows)
+        else:
+            count = db.executesql('SELECT count(*) FROM plugin_wiki_fts WHERE %s;' % where,(match,))[0][0]
+            if stop>len(rows):
+                offset = max(start,len(rows))
+                ids_page += [row[0] for row in db.executesql(
+                        'SELECT docid FROM plugin_wiki_fts WHERE %s ORDER BY docid LIMIT %i OFFSET %i;' % \
+                            (where,stop-offset,offset),(match,))]
+    else:
+        t = db.plugin_wiki_term
+        postings = db.executesql(db(t.term.belongs(words))._select(t.term,t.page,t.hits))
+        df, scores, matched = {}, {}, {}
+        for term, page_id, hits in postings:
+            df[term] = df.get(term,0)+1
+        n = db(w.id>0).count()
+        for term, page_id, hits in postings:
+            scores[page_id] = scores.get(page_id,0)+hits*math.log(1.0+float(n)/df[term])
+            matched[page_id] = matched.get(page_id,0)+1
+        ids = sorted([i for i in scores if matched[i]==len(words)],key=lambda i: -scores[i])
+        if not auth.user_id and ids:
+            visible = set(row[0] for row in db.executesql(
+                    db(w.id.belongs(ids))(w.public==True)(w.active==True)._select(w.id)))
+            ids = [i for i in ids if i in visible]
+        count, ids_page = len(ids), ids[start:stop]
+    pages = dict((row.id,row) for row in db(w.id.belongs(ids_page))\
+                     .select(w.id,w.slug,w.title,w.body)) if ids_page else {}
+    return count, [(pages[i],plugin_wiki_lib.snippet(pages[i].body,words)) \
+                       for i in ids_page if i in pages]
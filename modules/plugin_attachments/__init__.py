@@ -0,0 +1,78 @@
+"""
+derivation of plugin_attachments previews. The functions are module level
+so that a multiprocessing pool can run them outside the request threads.
+"""
+
+import os
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+IMAGES = ('jpg','jpeg','png','gif','bmp')
+TEXTS = ('txt','csv','py','md','html','css','js','xml','json')
+SUFFIXES = {'thumb':'.thumb.png','text':'.preview.txt'}
+
+def kind(extension):
+    """
+    'thumb', 'text' or None: the preview made for files with extension
+    """
+    extension = (extension or '').lower()
+    if extension in IMAGES and Image:
+        return 'thumb'
+    elif extension in TEXTS:
+        return 'text'
+    return None
+
+def derived(path,kind):
+    """
+    the path of the preview of the file at path, next to it
+    """
+    return path+SUFFIXES[kind]
+
+def thumbnail(source,dest,size=(128,128)):
+    image = Image.open(source)
+    image.thumbnail(size,Image.ANTIALIAS)
+    if not image.mode in ('RGB','RGBA'):
+        image = image.convert('RGBA')
+    image.save(dest+'.tmp','PNG')
+    os.rename(dest+'.tmp',dest)
+
+def text(source,dest,length=2048):
+    data = open(source,'rb').read(length)
+    data = data.decode('utf8','ignore').encode('utf8')
+    open(dest+'.tmp','wb').write(data)
+    os.rename(dest+'.tmp',dest)
+
+def derive(source,extension,size=(128,128),length=2048):
+    """
+    writes the preview of the file at source unless it exists; returns its
+    path or None. It runs in the pool so it never raises.
+    """
+    k = kind(extension)
+    if not k:
+        return None
+    dest = derived(source,k)
+    if not os.path.exists(dest):
+        try:
+            if k=='thumb':
+                thumbnail(source,dest,size)
+            else:
+                text(source,dest,length)
+        except Exception:
+            return None
+    return dest
+
+def pool(processes=2):
+    """
+    a multiprocessing pool, or None where processes cannot be started
+    """
+    try:
+        import multiprocessing
+        return multiprocessing.Pool(processes)
+    except (ImportError,OSError,NotImplementedError):
+        return None
@@ -0,0 +1,196 @@
+"""
+the inverted index of plugin_tagging. It lives in a module so that one
+copy is kept per process and shared by its requests.
+
+The records of a tag are kept as a bitmap, a dict {block: bits} where bit
+n of the python long bits is set if the record block*65536+n has the tag.
+Intersections and unions are then a & or | per block, done in C, and the
+record ids come out sorted.
+"""
+
+import binascii
+import threading
+import time
+
+BITS = 16
+MASK = (1<<BITS)-1
+
+def bitmap(record_ids):
+    """
+    the bitmap of the record ids
+    """
+    blocks = {}
+    for record_id in record_ids:
+        block = blocks.get(record_id>>BITS)
+        if block is None:
+            block = blocks[record_id>>BITS] = bytearray(1<<(BITS-3))
+        n = record_id&MASK
+        block[n>>3] |= 1<<(n&7)
+    return dict((key,long(binascii.hexlify(str(block[::-1])),16)) \
+                    for key, block in blocks.items())
+
+def has(a,record_id):
+    return a.get(record_id>>BITS,0)>>(record_id&MASK)&1
+
+def intersection(a,b):
+    c = {}
+    for key in (len(a)<=len(b) and a or b):
+        bits = a.get(key,0)&b.get(key,0)
+        if bits:
+            c[key] = bits
+    return c
+
+def union(a,b):
+    c = dict(a)
+    for key, bits in b.items():
+        c[key] = c.get(key,0)|bits
+    return c
+
+def count(a):
+    return sum([bin(bits).count('1') for bits in a.values()])
+
+def ids(a,start,stop):
+    """
+    the record ids of a from start to stop, in ascending order
+    """
+    result, skip, wanted = [], start, stop-start
+    for key in sorted(a):
+        if wanted<=0:
+            break
+        bits = bin(a[key])[:1:-1]
+        n = bits.count('1')
+        if skip>=n:
+            skip -= n
+            continue
+        low, high = 0, len(bits)-1
+        while low<high:
+            middle = (low+high)/2
+            if bits.count('1',0,middle+1)>skip:
+                high = middle
+            else:
+                low = middle+1
+        position, skip = low, 0
+        while position>=0 and wanted>0:
+            result.append((key<<BITS)+position)
+            wanted -= 1
+            position = bits.find('1',position+1)
+    return result
+
+def match(postings,tag_ids,mode):
+    """
+    the bitmap of the records having all (mode='all') or any (mode='any')
+    of the tags
+    """
+    bitmaps = [postings.get(tag_id,{}) for tag_id in tag_ids]
+    if mode=='all':
+        bitmaps.sort(key=len)
+        return reduce(intersection,bitmaps)
+    return reduce(union,bitmaps,{})
+
+def matches(postings,tag_ids,mode,record_id):
+    found = [has(postings.get(tag_id,{}),record_id) for tag_id in tag_ids]
+    return mode=='all' and all(found) or mode=='any' and any(found)
+
+class Index:
+    """
+    tag id -> bitmap of the tagged records, for the links of each table,
+    with the facets of the last searches. A table is loaded by load() and
+    expires ttl seconds later; in between update() applies the links
+    added and removed, and keeps the cached facets exact. At most size
+    facets are kept per table. names maps the tag ids seen in facets to
+    their names (tags are not renamed).
+    """
+    def __init__(self,ttl=600,size=256):
+        self.ttl, self.size = ttl, size
+        self.tables = {}
+        self.names = {}
+        self.lock = threading.Lock()
+    def last(self,table_name):
+        """
+        the highest link id read for the table, None if it has to be loaded
+        """
+        table = self.tables.get(table_name)
+        if table is None or (self.ttl is not None and table['loaded']+self.ttl<time.time()):
+            return None
+        return table['last']
+    def load(self,table_name,rows,last):
+        """
+        replaces the links of the table with rows of (tag id, record id),
+        read after the link id last
+        """
+        records = {}
+        for tag_id, record_id in rows:
+            records.setdefault(tag_id,[]).append(record_id)
+        postings = dict((tag_id,bitmap(record_ids)) for tag_id, record_ids in records.items())
+        self.lock.acquire()
+        try:
+            self.tables[table_name] = dict(loaded=time.time(),last=last,postings=postings,facets={})
+        finally:
+            self.lock.release()
+    def update(self,table_name,links,sign,last=0):
+        """
+        adds (sign=+1) or removes (sign=-1) the (tag id, record id) links of
+        a loaded table; links already added or removed are skipped. A facet
+        count changes when a link of a matching record changes, or when a
+        record starts or stops matching.
+        """
+        self.lock.acquire()
+        try:
+            table = self.tables.get(table_name)
+            if table is None:
+                return
+            table['last'] = max(table['last'],last)
+            postings, facets = table['postings'], table['facets']
+            if len(links)*len(facets)>10000:
+                facets.clear()
+            for tag_id, record_id in links:
+                bits = dict(postings.get(tag_id,{}))
+                if has(bits,record_id)==(sign>0):
+                    continue
+                before = dict((key,matches(postings,key[0],key[1],record_id)) for key in facets)
+                key, bit = record_id>>BITS, 1<<(record_id&MASK)
+                bits[key] = bits.get(key,0)^bit
+                if not bits[key]:
+                    del bits[key]
+                postings[tag_id] = bits
+                tags = None
+                for key, counts in facets.items():
+                    after = matches(postings,key[0],key[1],record_id)
+                    if before[key] and after:
+                        changed, delta = [tag_id], sign
+                    elif before[key]!=after:
+                        if tags is None:
+                            tags = [t for t, b in postings.items() if has(b,record_id)]
+                        changed, delta = tags+(sign<0 and [tag_id] or []), after and 1 or -1
+                    else:
+                        continue
+                    for t in changed:
+                        counts[t] = counts.get(t,0)+delta
+                        if not counts[t]:
+                            del counts[t]
+        finally:
+            self.lock.release()
+    def search(self,table_name,tag_ids,mode,start,stop,facets=True):
+        """
+        (number of matching records, their ids from start to stop,
+        {tag id: number of matching records having it} or {} if not facets)
+        """
+        self.lock.acquire()
+        try:
+            table = self.tables[table_name]
+            postings, cached = table['postings'], table['facets']
+            matched = match(postings,tag_ids,mode)
+            key = (tuple(sorted(tag_ids)),mode)
+            counts = facets and cached.get(key) or {}
+            if facets and not key in cached:
+                counts = {}
+                for tag_id, bits in postings.items():
+                    n = count(intersection(matched,bits))
+                    if n:
+                        counts[tag_id] = n
+                if len(cached)>=self.size:
+                    cached.clear()
+                cached[key] = counts
+            return count(matched), ids(matched,start,stop), dict(counts)
+        finally:
+            self.lock.release()
@@ -0,0 +1,135 @@
+"""
+rendering of plugin_wiki pages. It lives in a module so the regular
+expressions are compiled, and the page cache kept, once per process
+instead of once per request.
+"""
+
+import re
+import time
+import threading
+
+regex_code = re.compile('<code>(?P<code>.*?)</code>',re.S)
+regex_flv = re.compile('\<img\s+src="(?P<src>[^"]+\.(flv|wav|mp3|mpeg3|mp4|mpeg4|mov))"\s+alt="(?P<alt>[^"]*)"\s*/\>')
+regex_youtube = re.compile('\<img\s+src="http://www.youtube.com/watch\?v=(?P<code>\w+)"\s+alt="(?P<alt>[^"]*)"\s*/\>')
+regex_vimeo = re.compile('\<img\s+src="http://vimeo.com/(?P<code>\w+)"\s+alt="(?P<alt>[^"]*)"\s*/\>')
+
+FLV = '<embed allowfullscreen="true" allowscriptaccess="always" flashvars="height=305&width=490&file=\g<src>" height="305px" src="%s" width="490px"></embed>'
+YOUTUBE = """<object width="480" height="385"><param name="movie" value="http://www.youtube.com/v/\g<code>&hl=en_US&fs=1&"></param><param name="allowFullScreen" value="true"></param><param name="allowscriptaccess" value="always"></param><embed src="http://www.youtube.com/v/\g<code>&hl=en_US&fs=1&" type="application/x-shockwave-flash" allowscriptaccess="always" allowfullscreen="true" width="480" height="385"></embed></object>"""
+VIMEO = """<object width="400" height="250"><param name="allowfullscreen" value="true" /><param name="allowscriptaccess" value="always" /><param name="movie" value="http://vimeo.com/moogaloop.swf?clip_id=\g<code>&amp;server=vimeo.com&amp;show_title=1&amp;show_byline=1&amp;show_portrait=0&amp;color=&amp;fullscreen=1" /><embed src="http://vimeo.com/moogaloop.swf?clip_id=\g<code>&amp;server=vimeo.com&amp;show_title=1&amp;show_byline=1&amp;show_portrait=0&amp;color=&amp;fullscreen=1" type="application/x-shockwave-flash" allowfullscreen="true" allowscriptaccess="always" width="400" height="250"></embed></object><p><a href="http://vimeo.com/\g<code>">web2py production deployment on vps.net</a> from <a href="http://vimeo.com/user315328">mdipierro</a> on <a href="http://vimeo.com">Vimeo</a>.</p>"""
+
+def indent_code(match):
+    return '\n\n    %s\n\n' % '\n    '.join(match.group('code').split('\n'))
+
+def render(text,page_url,attachment_url,player_url):
+    """
+    returns the html of a page body; page_url, attachment_url and
+    player_url are the urls of plugin_wiki/page, plugin_attachments/attachment
+    and of the mediaplayer swf. Every <code> block is indented in a
+    single pass.
+    """
+    from gluon.contrib.markdown import WIKI
+    text = text or ''
+    text = text.replace('!(','![no name](')
+    text = text.replace('](page:','](%s/' % page_url)
+    text = text.replace('](attachment:','](%s/' % attachment_url)
+    text = regex_code.sub(indent_code,text)
+    html = WIKI(text).xml()
+    html = regex_flv.sub(FLV % player_url,html)
+    html = regex_youtube.sub(YOUTUBE,html)
+    html = regex_vimeo.sub(VIMEO,html)
+    return html
+
+def diff(old,new):
+    """
+    a line based delta turning old into new, as a json list of
+    [start, end, lines] replacements of old's lines
+    """
+    import difflib
+    from gluon.contrib import simplejson
+    a, b = (old or '').splitlines(True), (new or '').splitlines(True)
+    return simplejson.dumps([[i1,i2,b[j1:j2]] for tag,i1,i2,j1,j2 in \
+                                 difflib.SequenceMatcher(None,a,b).get_opcodes() \
+                                 if tag!='equal'])
+
+def patch(old,delta):
+    """
+    applies a delta computed by diff to old
+    """
+    from gluon.contrib import simplejson
+    lines = (old or '').splitlines(True)
+    for i1,i2,new in reversed(simplejson.loads(delta)):
+        lines[i1:i2] = [isinstance(line,unicode) and line.encode('utf8') or line \
+                            for line in new]
+    return ''.join(lines)
+
+regex_word = re.compile('\w+',re.U)
+
+def terms(text):
+    """
+    {term: hits} for the words of a text, lowercase and utf8 encoded
+    """
+    if not isinstance(text,unicode):
+        text = (text or '').decode('utf8','ignore')
+    counts = {}
+    for word in regex_word.findall(text.lower()):
+        word = word.encode('utf8')
+        counts[word] = counts.get(word,0)+1
+    return counts
+
+def snippet(text,words,size=200):
+    """
+    an escaped excerpt of text around the first of words, with every
+    occurrence of words in <b> (matched before escaping, so that words
+    like "amp" or "lt" do not match inside the entities)
+    """
+    import cgi
+    text = (text or '').decode('utf8','ignore')
+    words = [word.decode('utf8') for word in words]
+    regex = re.compile('(%s)' % '|'.join(re.escape(word) for word in words),re.I|re.U)
+    match = words and regex.search(text)
+    start = max(match and match.start()-size/4 or 0,0)
+    parts = regex.split(text[start:start+size]) if words else [text[start:start+size]]
+    excerpt = ''.join([i%2 and '<b>%s</b>' % cgi.escape(part) or cgi.escape(part) \
+                           for i, part in enumerate(parts)])
+    return ('...' if start else '')+excerpt.encode('utf8')+('...' if start+size<len(text) else '')
+
+class LRU:
+    """
+    a thread safe dict of at most size items that expire ttl seconds after
+    they are set; when full the least recently used quarter is dropped
+    """
+    def __init__(self,size=1000,ttl=60):
+        self.size, self.ttl = size, ttl
+        self.items = {}
+        self.lock = threading.Lock()
+    def get(self,key):
+        now = time.time()
+        self.lock.acquire()
+        try:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            elif item[1]+self.ttl<now:
+                del self.items[key]
+                return None
+            item[0] = now
+            return item[2]
+        finally:
+            self.lock.release()
+    def set(self,key,value):
+        now = time.time()
+        self.lock.acquire()
+        try:
+            if len(self.items)>=self.size and not key in self.items:
+                keys = sorted(self.items,key=lambda k: self.items[k][0])
+                for k in keys[:max(self.size/4,1)]:
+                    del self.items[k]
+            self.items[key] = [now,now,value]
+        finally:
+            self.lock.release()
+    def pop(self,key):
+        self.lock.acquire()
+        try:
+            self.items.pop(key,None)
+        finally:
+            self.lock.release()
@@ -0,0 +1,68 @@
+"""
+benchmark of offset and keyset paging in plugin_jqgrid_page. Run it from
+the web2py folder with the models of the application loaded:
+
+    python web2py.py -S <app> -M -R applications/<app>/private/plugin_jqgrid_paging_benchmark.py -A 1000000 20
+
+It fills a scratch SQLite table with 1,000,000 records (an indexed integer
+column and a string), then for pages of 20 rows at increasing depths, by
+id and by the integer column, times the limitby offset select data() used
+to run against plugin_jqgrid_page once the boundary of the previous page
+is cached (a keyset seek, as when the user turns pages). It also times
+dbset.count() against plugin_jqgrid_count. The scratch database is deleted
+at the end.
+"""
+
+import sys
+import time
+import random
+import tempfile
+import shutil
+
+from gluon.dal import DAL, Field
+
+RUNS = 5
+
+def median(f):
+    timings = []
+    for run in range(RUNS):
+        t0 = time.time()
+        f()
+        timings.append((time.time()-t0)*1000)
+    timings.sort()
+    return timings[len(timings)/2]
+
+def main(records,rows):
+    folder = tempfile.mkdtemp()
+    try:
+        scratch = DAL('sqlite://paging.sqlite',folder=folder)
+        table = scratch.define_table('plugin_jqgrid_benchmark',
+                                     Field('amount','integer',notnull=True),
+                                     Field('name'))
+        random.seed(0)
+        start = time.time()
+        for i in range(0,records,10000):
+            table.bulk_insert([dict(amount=random.randint(0,records/10),name='name %i' % j) \
+                                   for j in range(i,min(i+10000,records))])
+        scratch.executesql('CREATE INDEX plugin_jqgrid_benchmark_amount ON plugin_jqgrid_benchmark (amount, id);')
+        scratch.commit()
+        print '%i records in %.1fs' % (records,time.time()-start)
+        dbset = scratch(table.id>0)
+        fields = [table.id,table.amount,table.name]
+        for sidx in ('id','amount'):
+            orderby = sidx=='id' and table.id or table.amount|table.id
+            for page in [1,10,100,1000,10000,records/rows]:
+                if page>records/rows:
+                    continue
+                offset = median(lambda: dbset.select(orderby=orderby,limitby=(rows*(page-1),rows*page),
+                                                     *fields))
+                if page>1:
+                    plugin_jqgrid_page(dbset,table,fields,sidx,'asc',page-1,rows)
+                keyset = median(lambda: plugin_jqgrid_page(dbset,table,fields,sidx,'asc',page,rows))
+                print 'order by %-6s page %6i: offset %9.2fms, keyset %7.2fms' % (sidx,page,offset,keyset)
+        print 'count:               dbset.count() %9.2fms, plugin_jqgrid_count %7.2fms' % \
+            (median(dbset.count),median(lambda: plugin_jqgrid_count(dbset,table)))
+    finally:
+        shutil.rmtree(folder)
+
+main(int(sys.argv[1:] and sys.argv[1] or 1000000),int(sys.argv[2:] and sys.argv[2] or 20))
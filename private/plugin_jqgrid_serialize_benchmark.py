@@ -0,0 +1,82 @@
+"""
+microbenchmark of the serialization of plugin_jqgrid/data responses. Run
+it from the web2py folder with the models of the application loaded:
+
+    python web2py.py -S <app> -M -R applications/<app>/private/plugin_jqgrid_serialize_benchmark.py -A 1000
+
+It selects a page of 1,000 records of a scratch in memory SQLite table
+(string, integer, double, boolean and datetime columns, two of them with
+a represent) and times turning it into the json of the response with the
+per cell f(value,fieldname) data() used to have and with
+plugin_jqgrid_serializer. It also checks that both give the same rows.
+"""
+
+import sys
+import cgi
+import time
+import datetime
+
+from gluon.dal import DAL, Field
+from gluon.serializers import json
+from gluon.contrib import simplejson
+
+RUNS = 50
+
+def medians(*functions):
+    """
+    the median milliseconds of each function, run in turns so that both
+    see the same load
+    """
+    timings = [[] for f in functions]
+    for run in range(RUNS):
+        for f, times in zip(functions,timings):
+            t0 = time.time()
+            f()
+            times.append((time.time()-t0)*1000)
+    return [sorted(times)[len(times)/2] for times in timings]
+
+def before(table,records,columns,page,rows,nrecords):
+    """
+    the serialization of data() before plugin_jqgrid_serializer
+    """
+    items = {}
+    items['page']=page
+    items['total']=int((nrecords+(rows-1))/rows)
+    items['records']=nrecords
+    def f(value,fieldname):
+        r = table[fieldname].represent
+        if r: value=r(value)
+        try: return value.xml()
+        except: return cgi.escape(str(value))
+    items['rows']=[{'id':r.id,'cell':[f(r[x],x) for x in columns]} \
+                       for r in records]
+    return json(items)
+
+def after(table,records,columns,page,rows,nrecords):
+    """
+    the serialization of data() now
+    """
+    serialize = plugin_jqgrid_serializer(table,columns)
+    return '{"page":%i,"total":%i,"records":%i,"rows":[%s]}' % \
+        (page,(nrecords+rows-1)/rows,nrecords,','.join([serialize(r) for r in records]))
+
+def main(rows):
+    scratch = DAL('sqlite:memory')
+    table = scratch.define_table('plugin_jqgrid_benchmark',
+                                 Field('name'),
+                                 Field('amount','integer'),
+                                 Field('price','double',represent=lambda value: '%.2f' % (value or 0)),
+                                 Field('active','boolean',represent=lambda value: value and 'yes' or 'no'),
+                                 Field('created_on','datetime'))
+    now = datetime.datetime(2010,3,1)
+    table.bulk_insert([dict(name='name <%i> & co' % i,amount=i,price=i/3.0,active=i%2==0,
+                            created_on=now+datetime.timedelta(minutes=i)) for i in range(rows)])
+    columns = ['name','amount','price','active','created_on']
+    records = scratch(table.id>0).select(table.id,limitby=(0,rows),*[table[name] for name in columns])
+    args = (table,records,columns,1,rows,rows)
+    same = simplejson.loads(before(*args))==simplejson.loads(after(*args))
+    ms_before, ms_after = medians(lambda: before(*args),lambda: after(*args))
+    print '%i rows: before %.2fms, plugin_jqgrid_serializer %.2fms, same rows: %s' % \
+        (len(records),ms_before,ms_after,same and 'yes' or 'NO')
+
+main(int(sys.argv[1:] and sys.argv[1] or 1000))
@@ -0,0 +1,125 @@
+"""
+lock contention benchmark for the plugin_locking backends. Run it from the
+web2py folder with the models of the application loaded:
+
+    python web2py.py -S <app> -M -R applications/<app>/private/plugin_locking_contention.py -A 8 10
+
+8 threads compete for the leases of 10 records for a few seconds, through
+PluginLockingDAL (each thread with its own connection to a scratch SQLite
+database, like concurrent requests) and through one PluginLockingMemory.
+A thread that gets a lease holds it for a while, well within locktime, and
+then lets it expire; if any other user is granted the same record while it
+is held that is a double grant. It prints attempts, grants, acquire calls
+per second, double grants and errors for each backend, and FAIL if there
+were any.
+"""
+
+import os
+import sys
+import time
+import random
+import datetime
+import tempfile
+import shutil
+import threading
+
+from gluon.dal import DAL, Field
+
+LOCKTIME = 2 # seconds, DAL datetimes have one second resolution
+HOLD = 0.5 # seconds a lease is held once granted
+EXPIRATION = 3600
+
+def define(db,migrate):
+    db.define_table('plugin_locking_lock',
+                    Field('tablename'),
+                    Field('record_id','integer'),
+                    Field('created_by','integer'),
+                    Field('created_on','datetime'),
+                    Field('modified_on','datetime'),
+                    migrate=migrate)
+    return db
+
+def contend(leases_for,threads,records,seconds):
+    """
+    runs the threads, leases_for(i) is the backend used by thread i and is
+    called in that thread (DAL connections belong to the thread)
+    """
+    holders, mutex = {}, threading.Lock()
+    stats = dict(attempts=0,grants=0,double=0,errors=0)
+    stop = time.time()+seconds
+    def run(i):
+        leases, user_id = leases_for(i), i+1
+        while time.time()<stop:
+            record_id = random.randint(1,records)
+            try:
+                granted = leases.acquire('contention',record_id,user_id,LOCKTIME,
+                                         EXPIRATION,datetime.datetime.now())
+                leases.commit()
+            except Exception, e:
+                leases.rollback()
+                mutex.acquire()
+                stats['errors'] += 1
+                mutex.release()
+                sys.stderr.write('%s\n' % e)
+                continue
+            mutex.acquire()
+            stats['attempts'] += 1
+            if granted:
+                stats['grants'] += 1
+                if holders.get(record_id,user_id)!=user_id:
+                    stats['double'] += 1
+                holders[record_id] = user_id
+            mutex.release()
+            if granted:
+                time.sleep(HOLD)
+                mutex.acquire()
+                if holders.get(record_id)==user_id:
+                    del holders[record_id]
+                mutex.release()
+                # not renewed from now on, it expires after LOCKTIME
+                time.sleep(LOCKTIME)
+            else:
+                time.sleep(0.01)
+    workers = [threading.Thread(target=run,args=(i,)) for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    stats['rate'] = stats['attempts']/(time.time()-start)
+    return stats
+
+class Transactional:
+    """
+    a backend plus the commit/rollback of its connection
+    """
+    def __init__(self,leases,db=None):
+        self.leases, self.db = leases, db
+    def acquire(self,*args):
+        return self.leases.acquire(*args)
+    def commit(self):
+        if self.db: self.db.commit()
+    def rollback(self):
+        if self.db: self.db.rollback()
+
+def main(threads,records,seconds=12):
+    folder = tempfile.mkdtemp()
+    try:
+        uri = 'sqlite://contention.sqlite'
+        setup = define(DAL(uri,folder=folder),True)
+        setup.executesql('CREATE UNIQUE INDEX plugin_locking_lock_record ON plugin_locking_lock (tablename, record_id);')
+        setup.commit()
+        def connect(i):
+            db = define(DAL(uri,folder=folder),False)
+            return Transactional(PluginLockingDAL(db),db)
+        dal = contend(connect,threads,records,seconds)
+        memory = PluginLockingMemory()
+        mem = contend(lambda i: Transactional(memory),threads,records,seconds)
+    finally:
+        shutil.rmtree(folder)
+    for name, stats in [('PluginLockingDAL',dal),('PluginLockingMemory',mem)]:
+        print '%-20s %6i attempts %5i grants %8.1f/s %i double grants %i errors' % \
+            (name,stats['attempts'],stats['grants'],stats['rate'],stats['double'],stats['errors'])
+    print (dal['double'] or mem['double'] or dal['errors'] or mem['errors']) and 'FAIL' or 'PASS'
+
+main(int(sys.argv[1:] and sys.argv[1] or 8),int(sys.argv[2:] and sys.argv[2] or 10))
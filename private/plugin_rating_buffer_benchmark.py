@@ -0,0 +1,71 @@
+"""
+throughput of synchronous and buffered votes in plugin_rating. Run it from
+the web2py folder with the models of the application loaded:
+
+    python web2py.py -S <app> -M -R applications/<app>/private/plugin_rating_buffer_benchmark.py -A 5000
+
+It casts 5,000 votes of 200 users on 3 records, like a flash crowd, once
+with plugin_rating_vote and a commit per vote (what rate() does in a
+request) and once with plugin_rating_enqueue followed by one
+plugin_rating_flush. It prints the votes per second of both, the time of
+the flush, and checks that both leave the same totals. The buffered votes
+go through the journal of the application, so do not run it while the
+application takes buffered votes. The test rows and users are deleted at
+the end.
+"""
+
+import sys
+import time
+import random
+
+USERS = 200
+RECORDS = 3
+TABLENAME = 'auth_user' # the journal only takes votes on existing tables
+
+def votes(n,user_ids,record_ids):
+    random.seed(0)
+    return [(random.choice(record_ids),random.randint(1,5),random.choice(user_ids)) \
+                for i in range(n)]
+
+def totals(record_ids):
+    pm = db.plugin_rating_master
+    rows = db(pm.tablename==TABLENAME)(pm.record_id.belongs(record_ids))\
+        .select(pm.record_id,pm.rating,pm.rating_sum,pm.counter,orderby=pm.record_id)
+    return [(row.rating_sum,row.counter,round(row.rating,9)) for row in rows]
+
+def cleanup(user_ids,record_ids):
+    pm, pa = db.plugin_rating_master, db.plugin_rating_aux
+    masters = db(pm.tablename==TABLENAME)(pm.record_id.belongs(record_ids))
+    db(pa.master.belongs(masters._select(pm.id))).delete()
+    masters.delete()
+    db(db.auth_user.id.belongs(user_ids)).delete()
+    db.commit()
+
+def main(n):
+    user_ids = [db.auth_user.insert(first_name='plugin_rating_benchmark',last_name=str(i),
+                                    email='plugin_rating_benchmark_%i@example.com' % i)
+                for i in range(USERS)]
+    db.commit()
+    synchronous = [random.randint(10**8,10**9) for i in range(RECORDS)]
+    buffered = [record_id+1 for record_id in synchronous]
+    try:
+        start = time.time()
+        for record_id, rating, user_id in votes(n,user_ids,synchronous):
+            plugin_rating_vote(TABLENAME,record_id,rating,user_id)
+            db.commit()
+        sync_seconds = time.time()-start
+        start = time.time()
+        for record_id, rating, user_id in votes(n,user_ids,synchronous):
+            plugin_rating_enqueue(TABLENAME,record_id+1,rating,user_id)
+        enqueue_seconds = time.time()-start
+        start = time.time()
+        applied = plugin_rating_flush()
+        flush_seconds = time.time()-start
+        print 'synchronous: %i votes in %.2fs, %.0f votes/s' % (n,sync_seconds,n/sync_seconds)
+        print 'buffered:    %i votes in %.2fs, %.0f votes/s (%.0f/s with the flush of %s coalesced votes in %.2fs)' % \
+            (n,enqueue_seconds,n/enqueue_seconds,n/(enqueue_seconds+flush_seconds),applied,flush_seconds)
+        print 'same totals: %s' % (totals(synchronous)==totals(buffered) and 'yes' or 'NO')
+    finally:
+        cleanup(user_ids,synchronous+buffered)
+
+main(int(sys.argv[1:] and sys.argv[1] or 5000))
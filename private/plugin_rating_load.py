@@ -0,0 +1,93 @@
+"""
+concurrent vote load test for plugin_rating_vote. Run it from the web2py
+folder with the models of the application loaded:
+
+    python web2py.py -S <app> -M -R applications/<app>/private/plugin_rating_load.py -A 8 200
+
+It starts 8 worker processes (web2py shells like this one) that cast 200
+votes each, as a few users that keep changing their vote on the same few
+records and commit after every vote like a request would. Then it checks
+that for every master row rating_sum and counter match the plugin_rating_aux
+rows exactly, which is what lost updates or double counted re-votes break.
+The test rows and users are deleted at the end.
+"""
+
+import os
+import sys
+import random
+import subprocess
+import time
+
+USERS = 5
+RECORDS = 3
+TABLENAME = 'plugin_rating_load'
+
+def worker(user_ids,record_ids,votes,seed):
+    random.seed(seed)
+    errors = 0
+    for i in range(votes):
+        try:
+            plugin_rating_vote(TABLENAME,random.choice(record_ids),
+                               random.randint(1,5),random.choice(user_ids))
+            db.commit()
+        except Exception, e:
+            db.rollback()
+            errors += 1
+            sys.stderr.write('%s\n' % e)
+    print 'errors %i' % errors
+
+def check(record_ids):
+    pm, pa = db.plugin_rating_master, db.plugin_rating_aux
+    failures = 0
+    for master in db(pm.tablename==TABLENAME)(pm.record_id.belongs(record_ids)).select():
+        votes = db(pa.master==master.id).select(pa.rating)
+        expected_sum = sum([vote.rating for vote in votes])
+        if master.counter!=len(votes) or abs(master.rating_sum-expected_sum)>1e-9:
+            failures += 1
+            print 'FAIL record %s: counter %s rating_sum %s, expected %s and %s' % \
+                (master.record_id,master.counter,master.rating_sum,len(votes),expected_sum)
+    masters = db(pm.tablename==TABLENAME)(pm.record_id.belongs(record_ids)).count()
+    if masters!=len(record_ids):
+        failures += 1
+        print 'FAIL %i master rows for %i records' % (masters,len(record_ids))
+    return failures
+
+def cleanup(user_ids,record_ids):
+    pm, pa = db.plugin_rating_master, db.plugin_rating_aux
+    masters = db(pm.tablename==TABLENAME)(pm.record_id.belongs(record_ids))
+    db(pa.master.belongs(masters._select(pm.id))).delete()
+    masters.delete()
+    db(db.auth_user.id.belongs(user_ids)).delete()
+    db.commit()
+
+def main(processes,votes):
+    record_ids = [random.randint(10**8,10**9) for i in range(RECORDS)]
+    user_ids = [db.auth_user.insert(first_name='plugin_rating_load',last_name=str(i),
+                                    email='plugin_rating_load_%i@example.com' % i)
+                for i in range(USERS)]
+    db.commit()
+    web2py = os.path.join(request.folder,'..','..','web2py.py')
+    script = os.path.join(request.folder,'private','plugin_rating_load.py')
+    args = ['worker',','.join(map(str,user_ids)),','.join(map(str,record_ids)),str(votes)]
+    start = time.time()
+    workers = [subprocess.Popen([sys.executable,web2py,'-S',request.application,'-M',
+                                 '-R',script,'-A']+args+[str(seed)],
+                                stdout=subprocess.PIPE) for seed in range(processes)]
+    outputs = [w.communicate()[0] for w in workers]
+    elapsed = time.time()-start
+    errors = sum([int(line.split()[1]) for output in outputs \
+                      for line in output.splitlines() if line.startswith('errors ')])
+    print '%i votes in %.2fs (%.0f/s), %i errors' % \
+        (processes*votes,elapsed,processes*votes/elapsed,errors)
+    try:
+        failures = check(record_ids)
+    finally:
+        cleanup(user_ids,record_ids)
+    print (failures or errors) and 'FAIL' or 'PASS'
+
+if len(sys.argv)>1 and sys.argv[1]=='worker':
+    worker([int(i) for i in sys.argv[2].split(',')],
+           [int(i) for i in sys.argv[3].split(',')],
+           int(sys.argv[4]),int(sys.argv[5]))
+else:
+    main(int(sys.argv[1:] and sys.argv[1] or 8),int(sys.argv[2:] and sys.argv[2] or 200))
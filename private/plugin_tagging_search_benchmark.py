@@ -0,0 +1,103 @@
+"""
+benchmark of plugin_tagging_search on a large link table. Run it from the
+web2py folder with the models of the application loaded:
+
+    python web2py.py -S <app> -M -R applications/<app>/private/plugin_tagging_search_benchmark.py -A 100000 10
+
+It links 100,000 records to 10 tags each (1M links) drawn from 200 tags
+with a skewed popularity and times the load of plugin_tagging_index. Then
+it times plugin_tagging_search for one, two and three tags in 'all' and
+'any' mode, on the first and on a deep page, and prints the milliseconds
+and SQL statements of the first search without and with facets (the
+facets of a search are computed once), the median of the following ones
+and the median of searches made right after a link of a matching record
+is added and removed (which used to drop the cached results). The counts are checked against a GROUP BY/HAVING query.
+Everything is rolled back at the end.
+"""
+
+import sys
+import time
+import random
+
+TAGS = 200
+RUNS = 20
+
+def main(records,tags_per_record):
+    random.seed(0)
+    db.plugin_tagging_tag.created_by.default = None # no user in a shell
+    db_tag = db.plugin_tagging_tag
+    try:
+        names = ['benchmark_%03i/' % i for i in range(TAGS)]
+        tag_ids = db_tag.bulk_insert([dict(name=name,links=0) for name in names])
+        weights = [1.0/(i+1) for i in range(TAGS)]
+        total = sum(weights)
+        def pick():
+            x, i = random.random()*total, 0
+            while x>weights[i]:
+                x, i = x-weights[i], i+1
+            return i
+        start = time.time()
+        links = []
+        for record_id in range(1,records+1):
+            picked = set()
+            while len(picked)<tags_per_record:
+                picked.add(pick())
+            for i in picked:
+                links.append(dict(tag=tag_ids[i],table_name='plugin_tagging_benchmark',
+                                  record_id=record_id))
+            if len(links)>=50000:
+                plugin_tagging_insert_links(links)
+                links = []
+        plugin_tagging_insert_links(links)
+        db.executesql('ANALYZE;') if db._uri.startswith(('sqlite','postgres')) else None
+        print '%i links inserted in %.1fs' % (db(db.plugin_tagging_link.table_name==\
+            'plugin_tagging_benchmark').count(),time.time()-start)
+        start = time.time()
+        plugin_tagging_index_sync('plugin_tagging_benchmark')
+        print 'plugin_tagging_index loaded in %.1fs' % (time.time()-start)
+        adapter = db._adapter
+        execute, statements = adapter.execute, [0]
+        def counted(*a,**b):
+            statements[0] += 1
+            return execute(*a,**b)
+        def timed(f):
+            statements[0] = 0
+            t0 = time.time()
+            result = f()
+            return result, (time.time()-t0)*1000, statements[0]
+        db_link = db.plugin_tagging_link
+        for mode in ('all','any'):
+            for n in (1,2,3):
+                for page in (0,100):
+                    tags = [names[i] for i in (0,3,7)[:n]]
+                    search = lambda: plugin_tagging_search('plugin_tagging_benchmark',tags,mode,page)
+                    adapter.execute = counted
+                    try:
+                        result, bare, bare_statements = timed(
+                            lambda: plugin_tagging_search('plugin_tagging_benchmark',tags,mode,page,facets=False))
+                        result, first, first_statements = timed(search)
+                        warm = [timed(search) for run in range(RUNS)]
+                        changed, record_ids = [], plugin_tagging_search('plugin_tagging_benchmark',tags,mode)['ids']
+                        for run in range(RUNS):
+                            record_id = record_ids[run%len(record_ids)]
+                            plugin_tagging_add('plugin_tagging_benchmark',record_id,names[-1])
+                            link = db(db_link.table_name=='plugin_tagging_benchmark')\
+                                (db_link.record_id==record_id)(db_link.tag==tag_ids[-1]).select(db_link.id).first()
+                            plugin_tagging_remove('plugin_tagging_benchmark',record_id,[link.id])
+                            changed.append(timed(search))
+                    finally:
+                        adapter.execute = execute
+                    matches = db(db_link.table_name=='plugin_tagging_benchmark')\
+                        (db_link.tag.belongs([tag_ids[i] for i in (0,3,7)[:n]]))
+                    having = (db_link.tag.count(distinct=True)==n) if mode=='all' else None
+                    expected = len(db.executesql(matches._select(db_link.record_id,groupby=db_link.record_id,
+                                                                 having=having)))
+                    median = lambda runs: sorted([ms for r, ms, c in runs])[len(runs)/2]
+                    print '%-3s %i tags page %3i: %6i matches%s, first %6.2fms %i statements without facets, %6.2fms %i statements with, then %6.3fms %i statements, after a change %6.3fms' % \
+                        (mode,n,page,result['count'],result['count']!=expected and ' (WRONG)' or '',
+                         bare,bare_statements,first,first_statements,median(warm),max([c for r, ms, c in warm]),
+                         median(changed))
+    finally:
+        db.rollback()
+
+main(int(sys.argv[1:] and sys.argv[1] or 100000),int(sys.argv[2:] and sys.argv[2] or 10))
@@ -0,0 +1,114 @@
+"""
+benchmark of plugin_wiki_search over 50,000 pages. Run it from the web2py
+folder with the models of the application loaded:
+
+    python web2py.py -S <app> -M -R applications/<app>/private/plugin_wiki_search_benchmark.py -A 50000 100
+
+It creates 50,000 public pages of 100 words drawn from a vocabulary of
+5,000 words with a skewed frequency, indexes them with plugin_wiki_index
+and times plugin_wiki_search for one, two and three word queries of
+common and rare words, on the first and on a deep page, against the
+LIKE '%word%' scan of the bodies it replaces. It uses the index the
+application uses (FTS4 on SQLite, the posting lists elsewhere); add
+'postings' after the arguments to time the posting lists on SQLite too.
+The benchmark pages and their index entries are deleted at the end.
+"""
+
+import sys
+import time
+import bisect
+import random
+
+WORDS = 5000
+RUNS = 10
+
+def word(i):
+    """
+    a pronounceable word for each number (LIKE also matches the longer
+    words containing it, so its counts can be higher)
+    """
+    syllables = []
+    while True:
+        syllables.append('bcdfghklmnprstvz'[i%16]+'aeiou'[i/16%5])
+        i = i/80
+        if not i:
+            return ''.join(syllables)
+
+def timed(f,runs):
+    """
+    (last result of f(), median milliseconds, statements per run)
+    """
+    adapter = db._adapter
+    execute, statements, timings = adapter.execute, [0], []
+    def counted(*a,**b):
+        statements[0] += 1
+        return execute(*a,**b)
+    adapter.execute = counted
+    try:
+        for run in range(runs):
+            t0 = time.time()
+            result = f()
+            timings.append((time.time()-t0)*1000)
+    finally:
+        adapter.execute = execute
+    timings.sort()
+    return result, timings[len(timings)/2], statements[0]/runs
+
+def like(words,page,items_per_page=10):
+    w = db.plugin_wiki_page
+    query = reduce(lambda a,b: a&b,[w.body.like('%'+x+'%') for x in words])
+    dbset = db(query)(w.public==True)(w.active==True)
+    return dbset.count(), dbset.select(w.id,w.slug,w.title,w.body,orderby=w.id,
+                                       limitby=(page*items_per_page,(page+1)*items_per_page))
+
+def main(pages,words_per_page,postings):
+    global plugin_wiki_fts
+    w = db.plugin_wiki_page
+    if postings and plugin_wiki_fts:
+        plugin_wiki_fts = False
+        for sql in ['CREATE INDEX IF NOT EXISTS plugin_wiki_term_term ON plugin_wiki_term (term, page);',
+                    'CREATE INDEX IF NOT EXISTS plugin_wiki_term_page ON plugin_wiki_term (page);']:
+            db.executesql(sql)
+    random.seed(0)
+    vocabulary = [word(i) for i in range(WORDS)]
+    cumulative, total = [], 0.0
+    for i in range(WORDS):
+        total += 1.0/(i+1)
+        cumulative.append(total)
+    pick = lambda: vocabulary[min(bisect.bisect(cumulative,random.random()*total),WORDS-1)]
+    ids = []
+    try:
+        start = time.time()
+        for i in range(pages):
+            title = 'plugin wiki benchmark %i' % i
+            body = ' '.join([pick() for j in range(words_per_page)])
+            page_id = w.insert(slug='plugin-wiki-benchmark-%i' % i,title=title,body=body,
+                               active=True,public=True,created_by=None,modified_by=None)
+            plugin_wiki_index(page_id,title,body)
+            ids.append(page_id)
+            if i%5000==4999:
+                db.commit()
+        db.commit()
+        print '%i pages created and indexed (%s) in %.1fs' % \
+            (pages,plugin_wiki_fts and 'FTS4' or 'posting lists',time.time()-start)
+        queries = [('common',vocabulary[:1]),('common',vocabulary[:2]),('common',vocabulary[:3]),
+                   ('rare',vocabulary[500:501]),('rare',vocabulary[1:3]+vocabulary[500:501])]
+        for kind, words in queries:
+            for page in (0,20):
+                q = ' '.join(words)
+                (count, results), ms, statements = timed(lambda: plugin_wiki_search(q,page),RUNS)
+                (lcount, lresults), lms, lstatements = timed(lambda: like(words,page),3)
+                print '%-6s %-20s page %2i: search %6i matches %9.2fms %i statements, like %6i matches %9.2fms' % \
+                    (kind,q,page,count,ms,statements,lcount,lms)
+    finally:
+        for i in range(0,len(ids),500):
+            chunk = ids[i:i+500]
+            if plugin_wiki_fts:
+                db.executesql('DELETE FROM plugin_wiki_fts WHERE docid IN (%s);' % \
+                                  ','.join(map(str,chunk)))
+            db(db.plugin_wiki_term.page.belongs(chunk)).delete()
+            db(w.id.belongs(chunk)).delete()
+        db.commit()
+
+main(int(sys.argv[1:] and sys.argv[1] or 50000),int(sys.argv[2:] and sys.argv[2] or 100),
+     'postings' in sys.argv[3:])